@@ -8,6 +8,7 @@ firmware on the ROACH1. There is a server simulator derived from the hardware
 server for the 32K 1000MHz spectrometer firmware.
 """
 import calendar
+import collections
 import datetime
 import errno
 import h5py
@@ -17,12 +18,15 @@ import os
 import Pyro5
 import queue
 import re
+import threading
 import time
 
 from support.local_dirs import log_dir
 #from MonitorControl import ActionThread
 import MonitorControl
 import MonitorControl.BackEnds as BE
+import MonitorControl.BackEnds.ROACH1.archive as archive
+import MonitorControl.BackEnds.ROACH1.wireformat as wireformat
 import support.pyro.asyncio
 #from support.pyro import asyncio
 
@@ -30,6 +34,30 @@ logger = logging.getLogger(__name__)
 
 max_spectra_per_scan = 120 # 1 h
 max_num_scans = 120 # 5 d
+max_recent_records = 16
+
+
+class SpectrumReceiver(support.pyro.asyncio.CallbackReceiver):
+    """
+    Callback receiver which unpacks binary records
+
+    Records sent by the server with a binary ``wire_format`` are unpacked into
+    dicts of numpy arrays before being queued, so consumers of ``queue`` see
+    the same structure whichever format was used.  Each record is also given
+    to the client's ``record_arrived()``.
+    """
+    def __init__(self, parent=None, **kwargs):
+        super().__init__(parent=parent, **kwargs)
+        self.client = parent
+
+    @Pyro5.api.expose
+    @Pyro5.api.callback
+    def finished(self, msg):
+        if wireformat.is_packed(msg):
+            msg = wireformat.unpack_record(msg)
+        if self.client is not None:
+            self.client.record_arrived(msg)
+        super().finished(msg)
 
 
 class SAOclient(BE.Backend):
@@ -46,19 +74,24 @@ class SAOclient(BE.Backend):
     ROACH processors.
 
     This is a client class which uses the server controlling the spectrometer.
+    Unknown attributes are looked up on the server.  Each thread gets its own
+    proxy, so ownership does not have to be claimed on every call, and remote
+    methods are looked up once per thread.  ``query()`` gets the results of
+    several read-only server methods in one round trip.
 
     Attributes::
+      archive:      SpectrumArchive to which records are appended, if any
       bandwidth:
       freqs:
       hardware:
-      last_scan:
+      latest:       key (scan, record) of the newest record received
       logger:
       name:
       num_chan:
       parent:
+      recent:       the newest records received, keyed by (scan, record)
       roachnames:
       scans:
-      spectra_dict:
       titles:
     """
     num_chan = 32768
@@ -67,7 +100,8 @@ class SAOclient(BE.Backend):
                    "sao64k-3": "SAO3",
                    "sao64k-4": "SAO4"}
 
-    def __init__(self, name, inputs=None, output_names=None, hardware=None):
+    def __init__(self, name, inputs=None, output_names=None, hardware=None,
+                 archive_dir=None):
         """
         create an SAOclient instance
 
@@ -89,8 +123,13 @@ class SAOclient(BE.Backend):
 
         @param ROACHlist : ordered list of ROACH units in the spectrometer
         @type  ROACHlist : list of str
+
+        @param archive_dir : directory of a SpectrumArchive for the records
+        @type  archive_dir : str
         """
         mylogger = logging.getLogger(logger.name+".SAOclient")
+        # each thread's proxy and remote methods; see __getattr__
+        self._local = threading.local()
         BE.Backend.__init__(self, name, inputs=inputs, output_names=output_names)
         if hardware:
             uri = Pyro5.api.URI("PYRO:backend@localhost:50004")
@@ -126,32 +165,85 @@ class SAOclient(BE.Backend):
         else:
           self.freqs = BE.get_freq_array(self.bandwidth,self.num_chan)
         self.scans = {}
+        # the newest records, updated by the callback receiver
+        self.latest = None
+        self.recent = collections.OrderedDict()
+        self._recent_lock = threading.Lock()
+        # received records are appended to an archive on disk
+        if archive_dir:
+          self.archive = archive.SpectrumArchive(archive_dir, mode="a",
+                                                 names=self.roachnames,
+                                                 num_chan=self.data['num_chan'])
+        else:
+          self.archive = None
         if self.hardware:
           self.logger.debug("__init__: %s", self.roachnames)
           # callback handler
-          self.cb_receiver = support.pyro.asyncio.CallbackReceiver(parent=self)
+          self.cb_receiver = SpectrumReceiver(parent=self)
           for name in self.roachnames:
             self.logger.debug("__init__: init scans for %s", name)
             self.scans[name] = {"done": False, "scan": None, "record": None}
           self .logger.debug("__init__: scans: %s", self.scans)
-          # We want a data array with axes for frequency, roachnum, scan, record
-          #   for every record of every scan we want an array like this
-          #          freq roach1 roach2 roach3 roach4
-          #   and each row has the data for one spectrometer channel
-          #   So we know that this is always a 5x32768 array
-          #   I guess a dict is the easiest way to get the scan and record
-          #   spectra_dict[scan][record] = data_array
-          self.spectra_dict = {}          
     
     def __getattr__(self, name):
         """
         This passes unknown method and attribute requests to the server
+
+        Remote methods are cached for the calling thread.  Remote attributes
+        are fetched every time.  Private names are never passed on.
         """
-        self.logger.debug("__getattr__: checking hardware for '%s'",
-                          name)
-        if self.hardware is not None:
-            self.hardware._pyroClaimOwnership()
-            return getattr(self.hardware, name)
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if self.__dict__.get("hardware") is None:
+            return None
+        methods = self._methods()
+        if name in methods:
+            return methods[name]
+        self.logger.debug("__getattr__: checking hardware for '%s'", name)
+        proxy = self._proxy()
+        attr = getattr(proxy, name)
+        if name in proxy._pyroMethods:
+            methods[name] = attr
+        return attr
+
+    def _proxy(self):
+        """
+        the calling thread's own proxy for the server
+
+        ``self.hardware`` is never used for calls, since a Pyro proxy belongs
+        to one thread.
+        """
+        local = self._local
+        if not hasattr(local, "proxy"):
+            local.proxy = Pyro5.api.Proxy(self.hardware._pyroUri)
+        return local.proxy
+
+    def _methods(self):
+        """
+        the calling thread's cache of remote methods
+        """
+        local = self._local
+        if not hasattr(local, "methods"):
+            local.methods = {}
+        return local.methods
+
+    def query(self, *calls):
+        """
+        get the results of several read-only server methods in one call
+
+        Example::
+          scans, accums, gain = client.query("get_current_scans",
+                                             "get_current_accums",
+                                             ("rf_gain_get", "sao64k-1"))
+
+        @param calls : method names, or tuples of a method name and arguments
+        @type  calls : str or tuple
+
+        @return: list of results in the order of the calls
+        """
+        calls = [call if isinstance(call, str) else list(call)
+                 for call in calls]
+        return self.__getattr__("query")(calls)
 
     @property
     def scan_finished(self):
@@ -161,16 +253,56 @@ class SAOclient(BE.Backend):
     def get_last_spectrum(self):
       """
       serve last spectrum of the ones coming in
+
+      For every record we want an array like this::
+               freq roach1 roach2 roach3 roach4
+      where each column has the data for one spectrometer channel, so it is
+      always a 5x32768 array.  It is made when first asked for and kept with
+      the record.
+
+      @return: array, or None if no record has arrived yet
       """
-      # find the last record of the last scan
-      self.logger.debug("get_last_spectrum: called")
-      self.logger.debug("get_last_spectrum: spectra_dict keys: %s",
-                         list(self.spectra_dict.keys()))
-      last_scan = list(self.spectra_dict.keys())[-1]
-      last_record = self.spectra_dict[last_scan][-1]
-      self.logger.debug("get_last_spectrum: getting scan %d, record %d",
-                        last_scan, last_record)
-      return self.spectra_dict[last_scan][last_record]
+      with self._recent_lock:
+        key = self.latest
+        if key is None:
+          return None
+        entry = self.recent[key]
+      if entry["array"] is None:
+        msg = entry["msg"]
+        entry["array"] = numpy.vstack([self.freqs] +
+                                      [msg["data"][name]
+                                       for name in self.roachnames])
+      self.logger.debug("get_last_spectrum: scan %d, record %d", *key)
+      return entry["array"]
+
+    def get_recent_record(self, scan, record):
+      """
+      a combined record from the recent-records cache, or None
+      """
+      with self._recent_lock:
+        entry = self.recent.get((scan, record))
+      return entry["msg"] if entry else None
+
+    def record_arrived(self, msg):
+        """
+        called by the callback receiver with each combined record
+
+        The record becomes the latest, is added to the recent-records cache,
+        from which the oldest record is dropped when it holds more than
+        ``max_recent_records``, and is appended to the archive if there is
+        one.
+        """
+        if msg.get("type") != "data":
+            return
+        key = (msg["scan"], msg["record"])
+        with self._recent_lock:
+            self.recent[key] = {"msg": msg, "array": None}
+            self.recent.move_to_end(key)
+            while len(self.recent) > max_recent_records:
+                self.recent.popitem(last=False)
+            self.latest = key
+        if self.archive is not None:
+            self.archive.append(msg)
 
     def _reset_scans(self):
         self.scans = {name: {
@@ -183,20 +315,24 @@ class SAOclient(BE.Backend):
     def start_recording(self,
                         parent=None,
                         n_accums=max_spectra_per_scan,
-                        integration_time=5.0):
+                        integration_time=5.0,
+                        wire_format="lists"):
         """
         start a series of scans
         
         Scans are retrieved with the callback cb_receiver.finished() invokes
         by the server.  The data are put on cb_receiver.queue.
+
+        ``wire_format`` may be "float32" or "float64" to have the server send
+        packed binary records instead of lists (see ``wireformat``).
         """
         self.parent = parent
         self.integration = integration_time
         self.logger.debug("start_recording: scan of {} accums".format(n_accums))
         self.logger.debug("start_recording: integration time: %s", integration_time)
-        self.hardware._pyroClaimOwnership()
-        self.hardware.start(n_accums=n_accums,
+        self._proxy().start(n_accums=n_accums,
                             integration_time=integration_time,
+                            wire_format=wire_format,
                             callback=self.cb_receiver)
         self.logger.debug("start_recording: started")
 
@@ -205,9 +341,9 @@ class SAOclient(BE.Backend):
         """
         if self.hardware is not None:
             if kind == "server":
-                return self.hardware.server_help()
+                return self._proxy().server_help()
             elif kind == "backend":
-                return self.hardware.backend_help()
+                return self._proxy().backend_help()
         return "Types available: server, backend"
 
     def stop_recording(self):
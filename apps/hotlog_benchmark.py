@@ -0,0 +1,63 @@
+"""
+Cost per record of the per-record DEBUG messages
+
+This times the five messages ``SAOfwif.next_record()`` and ``action()`` log
+for each record, written the old way (``logger.debug`` with ``logtime()``)
+and with ``hotlog``, with the logger at INFO (messages off), at DEBUG with
+the stage disabled, and at DEBUG (messages on, formatted and written to
+os.devnull).
+"""
+import datetime
+import logging
+import os
+import time
+
+import MonitorControl.BackEnds.ROACH1.hotlog as hotlog
+
+records = 100000
+name, scan = "roach1", 1
+
+def logtime():
+  return datetime.datetime.utcnow().strftime("%H:%M:%S.%f")[:-3]
+
+def old_style(logger, count):
+  logger.debug("action: %s %s %s %s entered", name, scan, logtime(), count)
+  logger.debug("action: %s %s %s got integration %d", name, scan, logtime(),
+               count)
+  logger.debug("combine_data: %s %s %s %s entered", name, scan,
+               time.time()+time.altzone, count)
+  logger.debug("combine_data: %s %s %s stored %s", name, scan,
+               time.time()+time.altzone, count)
+  logger.debug("action: %s %s %s finished %s", name, scan, logtime(), count)
+
+def hot_style(log, count):
+  log.debug("action: %s %s %s %s entered", name, scan, hotlog.LazyTime(),
+            count)
+  log.debug("action: %s %s %s got integration %d", name, scan,
+            hotlog.LazyTime(), count)
+  log.debug("combine_data: %s %s %s %s entered", name, scan,
+            hotlog.LazyTime("gmt"), count)
+  log.debug("combine_data: %s %s %s stored %s", name, scan,
+            hotlog.LazyTime("gmt"), count)
+  log.debug("action: %s %s %s finished %s", name, scan, hotlog.LazyTime(),
+            count)
+
+def measure(function, target):
+  start = time.perf_counter()
+  for count in range(records):
+    function(target, count)
+  return 1e6*(time.perf_counter() - start)/records
+
+if __name__ == "__main__":
+  logger = logging.getLogger("hotlog_benchmark")
+  logger.addHandler(logging.FileHandler(os.devnull))
+  logger.propagate = False
+  log = hotlog.HotLogger(logger, "action")
+  print("%-28s %12s" % ("case", "us/record"))
+  for level, stage_on, label in [(logging.INFO, True, "INFO"),
+                                 (logging.DEBUG, False, "DEBUG, stage off"),
+                                 (logging.DEBUG, True, "DEBUG")]:
+    logger.setLevel(level)
+    hotlog.enable("action", stage_on)
+    print("%-28s %12.2f" % ("logger.debug, "+label, measure(old_style, logger)))
+    print("%-28s %12.2f" % ("hotlog, "+label, measure(hot_style, log)))
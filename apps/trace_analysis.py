@@ -0,0 +1,72 @@
+"""
+Pipeline latencies from a binary trace file
+
+The server writes the trace with ``SAObackend.start_trace()``.  The file is
+memory-mapped and, for each interval in ``timing.intervals``, the latency of
+every record is found with a few array operations, so a multi-day trace takes
+seconds rather than the minutes needed to parse the text log as
+``anal_servertest.py`` does.  With --plot, histograms like those of
+``anal_servertest.py`` are shown.
+
+Usage::
+  python trace_analysis.py [--plot] trace_20200903_083000.bin
+"""
+import argparse
+import numpy
+
+import MonitorControl.BackEnds.ROACH1.timing as timing
+
+percentiles = [50, 90, 99, 99.9]
+
+def summarize(header, events):
+  """
+  latency arrays in seconds for each interval and ROACH
+
+  Intervals between combined stages, which have ROACH index -1, are under
+  ``timing.combined``.
+  """
+  names = list(enumerate(header["roaches"])) + [(-1, timing.combined)]
+  summary = {}
+  for interval, (start, end) in timing.intervals.items():
+    roach, latency = timing.trace_latencies(header, events, start, end)
+    summary[interval] = {}
+    for num, name in names:
+      values = latency[roach == num]
+      if len(values):
+        summary[interval][name] = values
+  return summary
+
+def report(summary):
+  print("%-12s %-10s %8s %10s" % ("interval", "roach", "count", "mean ms") +
+        "".join("%10s" % ("p%s ms" % p) for p in percentiles))
+  for interval, by_roach in summary.items():
+    for name, values in by_roach.items():
+      print("%-12s %-10s %8d %10.2f" % (interval, name, len(values),
+                                        1000*values.mean()) +
+            "".join("%10.2f" % (1000*value)
+                    for value in numpy.percentile(values, percentiles)))
+
+def plot(summary):
+  from pylab import figure, hist, legend, show, title, xlabel
+  for interval, by_roach in summary.items():
+    if not by_roach:
+      continue
+    figure()
+    for name, values in by_roach.items():
+      hist(values, histtype='step', label=name)
+    legend()
+    title(interval.capitalize() + ' Times')
+    xlabel('Seconds')
+  show()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+  parser.add_argument("trace", help="binary trace file")
+  parser.add_argument("--plot", action="store_true", help="show histograms")
+  args = parser.parse_args()
+  header, events = timing.read_trace(args.trace)
+  print("%d events from %s" % (len(events), ", ".join(header["roaches"])))
+  summary = summarize(header, events)
+  report(summary)
+  if args.plot:
+    plot(summary)
@@ -0,0 +1,63 @@
+"""
+Compare the list and binary wire formats for combined records
+
+For each Pyro serializer this reports the bytes per record and the time to
+serialize a record and to get it back as arrays, for the default "lists" path
+and for packed float32 and float64 records.  Serializers which cannot carry
+``bytes`` are reported as unsupported for the packed formats.
+"""
+import numpy
+import time
+
+import Pyro5.errors
+import Pyro5.serializers
+import MonitorControl.BackEnds.ROACH1.combiner as combiner
+import MonitorControl.BackEnds.ROACH1.wireformat as wireformat
+
+num_chan = 32768
+roaches = ["roach1", "roach2", "roach3", "roach4"]
+repeats = 5
+
+def make_record():
+  rng = numpy.random.default_rng()
+  return {"scan": 1, "record": 1, "type": "data",
+          "time": {name: time.time() for name in roaches},
+          "data": {name: 5e6 + rng.standard_normal(num_chan)
+                   for name in roaches}}
+
+def encode(msg, wire_format):
+  dtype = wireformat.wire_formats[wire_format]
+  if dtype:
+    return wireformat.pack_record(msg, dtype=dtype)
+  return combiner.serializable(msg)
+
+def decode(payload):
+  if wireformat.is_packed(payload):
+    return wireformat.unpack_record(payload)
+  return {name: numpy.array(spectrum)
+          for name, spectrum in payload["data"].items()}
+
+def measure(serializer, msg, wire_format):
+  start = time.perf_counter()
+  for count in range(repeats):
+    wire = serializer.dumps(encode(msg, wire_format))
+  packed = time.perf_counter()
+  for count in range(repeats):
+    decode(serializer.loads(wire))
+  unpacked = time.perf_counter()
+  return len(wire), (packed-start)/repeats, (unpacked-packed)/repeats
+
+if __name__ == "__main__":
+  msg = make_record()
+  print("%-10s %-8s %12s %10s %10s" % ("serializer", "format", "bytes/record",
+                                      "dumps ms", "loads ms"))
+  for name, serializer in Pyro5.serializers.serializers.items():
+    for wire_format in wireformat.wire_formats:
+      try:
+        nbytes, dumps, loads = measure(serializer, msg, wire_format)
+      except Pyro5.errors.SerializeError:
+        # e.g. the json serializer cannot send bytes
+        print("%-10s %-8s %12s" % (name, wire_format, "unsupported"))
+        continue
+      print("%-10s %-8s %12d %10.1f %10.1f" % (name, wire_format, nbytes,
+                                              1000*dumps, 1000*loads))
@@ -0,0 +1,211 @@
+"""
+File-backed archive of combined spectrometer records
+
+A client which keeps every record it receives in a dict runs out of memory in
+a long session.  A ``SpectrumArchive`` instead appends each combined record
+(see ``combiner``) to files in a directory::
+
+  header.json  - version, ROACH names, number of channels, data type
+  spectra.dat  - raw little-endian float32, (records x ROACHs x channels)
+  index.dat    - one entry per record: scan, record and ROACH times
+
+Both data files are only ever appended to and the spectra are written before
+the index entry, so the number of index entries is always the number of
+complete records.  Other processes can open the directory read-only while it
+is being written; ``refresh()`` picks up the records added since.  Any record
+is read in O(1) from a memory map, by position or by (scan, record).
+"""
+import json
+import logging
+import numpy
+import os
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+header_file = "header.json"
+data_file = "spectra.dat"
+index_file = "index.dat"
+
+def index_dtype(n_roach):
+  """
+  structured type of an index entry
+  """
+  return numpy.dtype([("scan", "<i4"), ("record", "<i4"),
+                      ("time", "<f8", (n_roach,))])
+
+class SpectrumArchive(object):
+  """
+  Spectra archived in memory-mapped files
+
+  Attributes::
+    dtype    - numpy dtype of the spectra
+    index    - structured array with scan, record and times of each record
+    logger   - logging.Logger instance
+    mode     - "r" to read only or "a" to append as well
+    names    - ROACH names in the order of the roach axis
+    num_chan - number of channels per spectrum
+    path     - directory holding the files
+    spectra  - (records x ROACHs x channels) array mapped from the data file
+  """
+  def __init__(self, path, mode="r", names=None, num_chan=None):
+    """
+    open an archive, creating it if it does not exist and ``mode`` is "a"
+
+    @param path : directory for the archive files
+    @type  path : str
+
+    @param mode : "r" or "a"
+    @type  mode : str
+
+    @param names : ROACH names in order; needed to create an archive
+    @type  names : list of str
+
+    @param num_chan : channels per spectrum; needed to create an archive
+    @type  num_chan : int
+    """
+    self.logger = logging.getLogger(logger.name+".SpectrumArchive")
+    if mode not in ("r", "a"):
+      raise ValueError("mode must be 'r' or 'a'")
+    self.path = path
+    self.mode = mode
+    headerpath = os.path.join(path, header_file)
+    if not os.path.exists(headerpath):
+      if mode == "r":
+        raise IOError("no spectrum archive in %s" % path)
+      if names is None or num_chan is None:
+        raise ValueError("names and num_chan are needed for a new archive")
+      self._create(list(names), num_chan)
+    with open(headerpath) as header:
+      header = json.load(header)
+    if header["version"] != VERSION:
+      raise ValueError("%s is a version %s archive" % (path, header["version"]))
+    self.names = header["names"]
+    self.num_chan = header["num_chan"]
+    self.dtype = numpy.dtype(header["dtype"])
+    if names is not None and list(names) != self.names:
+      raise ValueError("%s holds data for %s" % (path, self.names))
+    self.index_type = index_dtype(len(self.names))
+    self.record_shape = (len(self.names), self.num_chan)
+    self.record_bytes = self.dtype.itemsize*len(self.names)*self.num_chan
+    self.positions = {}
+    self._count = 0
+    self.spectra = numpy.empty((0,)+self.record_shape, dtype=self.dtype)
+    self.index = numpy.empty(0, dtype=self.index_type)
+    if mode == "a":
+      self._data = open(os.path.join(path, data_file), "ab")
+      self._index = open(os.path.join(path, index_file), "ab")
+      # drop spectra without an index entry, left by an interrupted append
+      count = os.path.getsize(os.path.join(path, index_file)) \
+                                                  // self.index_type.itemsize
+      self._data.truncate(count*self.record_bytes)
+      self._index.truncate(count*self.index_type.itemsize)
+    self.refresh()
+    self.logger.debug("__init__: %s has %d records", path, len(self))
+
+  def _create(self, names, num_chan):
+    """
+    write the header and empty data files
+    """
+    if not os.path.exists(self.path):
+      os.makedirs(self.path)
+    for name in (data_file, index_file):
+      open(os.path.join(self.path, name), "wb").close()
+    header = {"version": VERSION, "names": names, "num_chan": num_chan,
+              "dtype": "<f4"}
+    with open(os.path.join(self.path, header_file), "w") as headerfile:
+      json.dump(header, headerfile)
+    self.logger.info("_create: new archive in %s", self.path)
+
+  def __len__(self):
+    return self._count
+
+  def refresh(self):
+    """
+    map any records added since the archive was opened or last refreshed
+
+    @return: number of records
+    """
+    count = os.path.getsize(os.path.join(self.path, index_file)) \
+                                                  // self.index_type.itemsize
+    if count > self.index.shape[0]:
+      self.index = numpy.memmap(os.path.join(self.path, index_file),
+                                dtype=self.index_type, mode="r",
+                                shape=(count,))
+      self.spectra = numpy.memmap(os.path.join(self.path, data_file),
+                                  dtype=self.dtype, mode="r",
+                                  shape=(count,)+self.record_shape)
+    for position in range(self._count, count):
+      entry = self.index[position]
+      self.positions[(int(entry["scan"]), int(entry["record"]))] = position
+    self._count = max(self._count, count)
+    return self._count
+
+  def append(self, msg):
+    """
+    add a combined record
+
+    @param msg : combined record with 'scan', 'record', 'time' and 'data'
+    @type  msg : dict
+
+    @return: position of the record
+    """
+    if self.mode != "a":
+      raise IOError("%s is open read-only" % self.path)
+    spectra = numpy.empty(self.record_shape, dtype=self.dtype)
+    entry = numpy.zeros(1, dtype=self.index_type)
+    entry["scan"] = msg["scan"]
+    entry["record"] = msg["record"]
+    for num, name in enumerate(self.names):
+      spectra[num] = msg["data"][name]
+      entry["time"][0, num] = msg["time"][name]
+    self._data.write(spectra.tobytes())
+    self._data.flush()
+    self._index.write(entry.tobytes())
+    self._index.flush()
+    position = self._count
+    self.positions[(int(msg["scan"]), int(msg["record"]))] = position
+    self._count += 1
+    return position
+
+  def position(self, scan, record):
+    """
+    position of a record in the archive; refreshes once if it is not known
+    """
+    key = (scan, record)
+    if key not in self.positions:
+      self.refresh()
+    return self.positions[key]
+
+  def get(self, position):
+    """
+    a record by position; negative positions count from the end
+
+    @return: dict with 'scan', 'record', 'time' and 'data' like the combined
+             record, with the spectra as read-only arrays in the memory map
+    """
+    if position < 0:
+      position += self._count
+    if position >= self.index.shape[0]:
+      self.refresh()
+    entry = self.index[position]
+    spectra = self.spectra[position]
+    return {"scan": int(entry["scan"]), "record": int(entry["record"]),
+            "type": "data",
+            "time": {name: float(entry["time"][num])
+                     for num, name in enumerate(self.names)},
+            "data": {name: spectra[num] for num, name in enumerate(self.names)}}
+
+  def get_record(self, scan, record):
+    """
+    a record by scan and record number
+    """
+    return self.get(self.position(scan, record))
+
+  def close(self):
+    """
+    close the files being appended to
+    """
+    if self.mode == "a":
+      self._data.close()
+      self._index.close()
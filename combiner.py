@@ -7,35 +7,230 @@ keys::
   name   - the name or ID of the DSP
   scan   - the (1-based) number of the scan being acquired
   record - the (1-based) number of the record in the scan
+
+Spectra are passed to the combiner as numpy arrays and copied once into a
+preallocated ``ScanBuffer``.  The combined records handed to ``process_data``
+hold views into that buffer.  Anything which must cross a process boundary
+should be passed through ``serializable()`` first.
+
+Each combined record has a 'missing' list.  If ``max_record_age`` is set, a
+record which is still incomplete that many seconds after its first spectrum
+arrived is emitted anyway.  The spectra of the DSPs which had not reported
+are then NaN (zero for integer data), their times NaN, and their names are
+in 'missing'.  What happens to their spectra if they arrive later depends on
+``late_policy``: "drop" discards them and "patch" passes them to
+``process_patch`` as a record of type 'patch' holding only those spectra.
 """
 import calendar
+import collections
 import logging
+import numpy
 import queue
+import threading
 import time
 
-import MonitorControl as MC 
+import MonitorControl as MC
+import MonitorControl.BackEnds.ROACH1.hotlog as hotlog
+import MonitorControl.BackEnds.ROACH1.queues as queues
 
 logger = logging.getLogger(__name__)
 
 def nowgmt():
   return time.time()+ time.altzone
 
+def serializable(msg):
+  """
+  Convert the arrays in a combiner message to lists
+
+  This is the boundary between the combiner, which handles numpy arrays, and
+  serializers like Pyro's which do not.  Nested dicts are converted too.  The
+  original message is not changed.
+  """
+  if isinstance(msg, dict):
+    return {key: serializable(value) for key, value in msg.items()}
+  elif hasattr(msg, "tolist"):
+    return msg.tolist()
+  else:
+    return msg
+
+class ScanBuffer(object):
+  """
+  Preallocated storage for the records of one scan
+
+  The records are kept in a ring of ``depth`` slots, each holding one
+  (DSPs x channels) block, so a scan of any length takes constant memory as
+  long as each record is completed before the ring comes around to it again.
+  A slot is freed as soon as its record has been emitted.  The ring only moves
+  forward: a record whose slot is needed by a newer one is emitted as it is,
+  and a spectrum for a record older than its slot allows is late (``is_late``).
+
+  Attributes::
+    count    - number of DSPs which have reported, for each slot
+    data     - (slots x DSPs x channels) array of spectra
+    emitted  - number of records of this scan emitted so far
+    index    - position of each DSP, keyed by name
+    newest   - highest record number stored
+    present  - (slots x DSPs) flags for the DSPs which have reported
+    record   - record number held in each slot; 0 if the slot is free
+    scan     - scan number
+    started  - monotonic time of the first spectrum in each slot
+    times    - (slots x DSPs) array of record times
+  """
+  def __init__(self, scan, dsplist, num_chan, depth, dtype=float):
+    """
+    allocate the buffer for one scan
+    """
+    self.scan = scan
+    self.index = {name: num for num, name in enumerate(dsplist)}
+    self.data = numpy.zeros((depth, len(dsplist), num_chan), dtype=dtype)
+    self.times = numpy.zeros((depth, len(dsplist)))
+    self.present = numpy.zeros((depth, len(dsplist)), dtype=bool)
+    self.count = [0]*depth
+    self.record = [0]*depth
+    self.started = [0.]*depth
+    self.emitted = 0
+    self.newest = 0
+
+  @property
+  def pending(self):
+    """
+    number of records started but not yet emitted
+    """
+    return sum(1 for record in self.record if record)
+
+  def slot(self, record):
+    """
+    slot for a (1-based) record number
+    """
+    return (record-1) % len(self.record)
+
+  def is_late(self, record):
+    """
+    True if a newer record holds, or has held, this record's slot
+    """
+    return self.record[self.slot(record)] > record or \
+           record <= self.newest - len(self.record)
+
+  def store(self, name, record, data, rectime):
+    """
+    copy one DSP's spectrum into the record's slot
+
+    @return: True if the record is now complete
+    """
+    slot = self.slot(record)
+    if self.record[slot] != record:
+      self.clear(slot)
+      self.record[slot] = record
+      self.started[slot] = time.monotonic()
+      self.newest = max(self.newest, record)
+    dsp = self.index[name]
+    self.data[slot, dsp] = data
+    self.times[slot, dsp] = rectime
+    if not self.present[slot, dsp]:
+      self.present[slot, dsp] = True
+      self.count[slot] += 1
+    return self.count[slot] == len(self.index)
+
+  def views(self, slot):
+    """
+    spectra and times for a slot, keyed by DSP name
+
+    The spectra are views into the buffer, valid until the slot is reused.
+    """
+    data = {}
+    times = {}
+    for name, dsp in self.index.items():
+      data[name] = self.data[slot, dsp]
+      times[name] = float(self.times[slot, dsp])
+    return data, times
+
+  def missing(self, slot):
+    """
+    names of the DSPs which have not reported for a slot
+    """
+    return [name for name, dsp in self.index.items()
+            if not self.present[slot, dsp]]
+
+  def fill_missing(self, slot):
+    """
+    set the spectra of the missing DSPs to NaN (0 if integer) and times to NaN
+    """
+    absent = ~self.present[slot]
+    if self.data.dtype.kind in "fc":
+      self.data[slot, absent] = numpy.nan
+    else:
+      self.data[slot, absent] = 0
+    self.times[slot, absent] = numpy.nan
+
+  def expired(self, before):
+    """
+    slots holding records started before a monotonic time, in record order
+    """
+    slots = [slot for slot, record in enumerate(self.record)
+             if record and self.started[slot] < before]
+    return sorted(slots, key=lambda slot: self.record[slot])
+
+  def clear(self, slot):
+    """
+    free a slot
+    """
+    self.present[slot] = False
+    self.count[slot] = 0
+    self.record[slot] = 0
+
 class DataCombiner(MC.ActionThread):
   """
   class to combine spectra from parallel processors
+
+  Records are stored in a ``ScanBuffer`` for each scan in progress.  At most
+  ``max_scans`` scans are kept; when another scan starts, the oldest one is
+  dropped.  A scan is also dropped as soon as all ``records_per_scan`` records
+  have been emitted, if that number is known.  Spectra which arrive for a
+  finished scan are discarded.  ``begin_scan()`` must be called before a scan
+  number is used again.
   
   Atributes
   =========
-    inqueue
+    depth            - number of record slots in each scan buffer
+    finished         - scans recently dropped after all records were emitted
+    inqueue          - queues.BoundedQueue of DSP messages
+    late_policy      - "drop" or "patch" for spectra of records already
+                       emitted without them
+    lock             - held while the scan buffers are changed
     logger
-    outqueue
-    scans
-    spectra_dict
+    max_record_age   - seconds to wait for all the DSPs; None: for ever
+    max_scans        - number of scans to keep
+    partials         - names still missing from records emitted incomplete,
+                       by scan and record
+    records_per_scan - number of records in a scan, if known
+    scans            - ScanBuffer for each scan in progress
+    timer            - timing.StageTimer marking 'received' and 'stored'
   """
-  def __init__(self, dsplist=None):
+  def __init__(self, dsplist=None, records_per_scan=None, max_scans=2,
+                     depth=16, timer=None, max_record_age=None,
+                     late_policy="drop", queue_size=64, queue_policy="block",
+                     spill_dir=None):
     """
     initialize a data combiner
+
+    @param max_record_age : seconds after which an incomplete record is
+                            emitted; default: wait for all the DSPs
+    @type  max_record_age : float
+
+    @param late_policy : "drop" or "patch"
+    @type  late_policy : str
+
+    @param queue_size : most DSP messages held in memory by ``inqueue``
+    @type  queue_size : int
+
+    @param queue_policy : what ``inqueue`` does when full; see ``queues``
+    @type  queue_policy : str
+
+    @param spill_dir : directory for the "spill" policy
+    @type  spill_dir : str
     """
+    if late_policy not in ("drop", "patch"):
+      raise ValueError("late_policy must be 'drop' or 'patch'")
     if dsplist:
       self.dsplist = dsplist
     else:
@@ -43,21 +238,107 @@ class DataCombiner(MC.ActionThread):
     mylogger = logging.getLogger(logger.name+".DataCombiner")
     MC.ActionThread.__init__(self, self, self.get_data, name="combiner")
     self.logger = mylogger
-    self.inqueue = queue.Queue()
-    self.timedata = {}
-    self.spectra_dict = {}
+    self.hotlog = hotlog.HotLogger(mylogger, "combine")
+    self.inqueue = queues.BoundedQueue(queue_size, policy=queue_policy,
+                                       spill_dir=spill_dir, name="combiner")
+    self.records_per_scan = records_per_scan
+    self.max_scans = max_scans
+    self.depth = depth
+    self.scans = collections.OrderedDict()
+    self.finished = collections.deque(maxlen=max_scans)
+    self.partials = collections.OrderedDict()
+    self.timer = timer
+    self.max_record_age = max_record_age
+    self.late_policy = late_policy
+    self._next_expiry_check = 0
+    # with asyncio acquisition, records are combined on the event loop while
+    # this thread expires them
+    self.lock = threading.Lock()
     self.daemon = True
     self.start()
     
   def get_data(self):
     """
     move data from processor(s) to data handler
+
+    With a ``max_record_age`` the queue is polled so that incomplete records
+    are emitted on time even when no more data arrive.
     """
     while True:
-      data = self.inqueue.get()
-      self.combine_data(data)
+      if self.max_record_age:
+        try:
+          data = self.inqueue.get(timeout=self.max_record_age/4)
+        except queue.Empty:
+          data = None
+      else:
+        data = self.inqueue.get()
+      if data is not None:
+        self.combine_data(data)
+      self.expire()
     self.join()
 
+  def expire(self):
+    """
+    emit the records which have waited longer than ``max_record_age``
+    """
+    if not self.max_record_age:
+      return
+    now = time.monotonic()
+    if now < self._next_expiry_check:
+      return
+    self._next_expiry_check = now + self.max_record_age/4
+    with self.lock:
+      for scan, buf in list(self.scans.items()):
+        for slot in buf.expired(now - self.max_record_age):
+          self.logger.warning("expire: scan %s record %s emitted without %s",
+                              scan, buf.record[slot], buf.missing(slot))
+          self.emit(buf, slot)
+
+  def begin_scan(self, scan):
+    """
+    forget any earlier scan with this number
+
+    Scan numbers are used again after the back end's scans are reset, so
+    whatever is remembered of an old scan must not be applied to a new one.
+    """
+    with self.lock:
+      while scan in self.finished:
+        self.finished.remove(scan)
+      self.partials.pop(scan, None)
+      old_buffer = self.scans.pop(scan, None)
+    if old_buffer and old_buffer.pending:
+      self.logger.warning("begin_scan: dropped old scan %s with %d incomplete"
+                          " records", scan, old_buffer.pending)
+
+  def reset(self):
+    """
+    forget all scans
+    """
+    with self.lock:
+      self.scans.clear()
+      self.finished.clear()
+      self.partials.clear()
+
+  def scan_buffer(self, scan, data):
+    """
+    get the buffer for a scan, making it (and dropping the oldest) if needed
+    """
+    if scan in self.scans:
+      return self.scans[scan]
+    while len(self.scans) >= self.max_scans:
+      old_scan, old_buffer = self.scans.popitem(last=False)
+      if old_buffer.pending:
+        self.logger.warning("scan_buffer: dropped scan %s with %d incomplete"
+                            " records", old_scan, old_buffer.pending)
+    data = numpy.asarray(data)
+    if self.records_per_scan:
+      depth = min(self.depth, self.records_per_scan)
+    else:
+      depth = self.depth
+    self.scans[scan] = ScanBuffer(scan, self.dsplist, data.shape[-1], depth,
+                                  dtype=data.dtype)
+    return self.scans[scan]
+
   def combine_data(self, result):
     """
     combine DSP records into one 2D record
@@ -65,56 +346,115 @@ class DataCombiner(MC.ActionThread):
     name = result['name']
     scan = result['scan']
     record = result["record"]
-    rectime = result["time"]
-    self.logger.debug("combine_data: %s %s %s %s entered", 
-                      name, scan, nowgmt(), record)
+    self.hotlog.debug("combine_data: %s %s %s %s entered",
+                      name, scan, hotlog.LazyTime("gmt"), record)
     if result['type'] == 'spectrum':
-      data = result["data"]
-      #self.logger.debug("combine_data: %s got: %s", result['name'], data[:10]) 
-      # create spectra_dict[scan], if needed
-      if scan in self.spectra_dict:
-        # not needed
-        pass
-      elif list(self.spectra_dict.keys()) == []:
-        # empty dict.  Creat one with the current scan
-        self.spectra_dict = {scan: {}}
-        self.timedata = {scan: {}}
-      else:
-        # add this scan to the dict
-        self.spectra_dict[scan] = {}
-        self.timedata[scan] = {}
-      # create spectra_dict[scan][record], if needed
-      if record in self.spectra_dict[scan]:
-        # not needed
-        pass
-      else:
-        # create an empty dict for this record
-        self.spectra_dict[scan][record] = {}
-        self.timedata[scan][record] = {}
-      # add the data for this ROACH to this record
-      self.spectra_dict[scan][record][name] = data
-      self.timedata[scan][record][name] = rectime
-      if self.spectra_dict[scan][record][name]:
-        self.logger.debug("combine_data: %s %s %s stored %s", 
-                          name, scan, nowgmt(), record)
-      else:
-        self.logger.debug("combine_data: %s %s %s new scan",
-                          name, scan, nowgmt())
-      # Are all the ROACHs' data in the spectraDict structure? If so, output 
-      this_record = self.spectra_dict[scan][record]
-      if len(this_record) == len(self.dsplist):
-        this_time = self.timedata[scan][record]
-        msg = {"scan": scan, "record": record, "time": this_time,
-               "type": "data", "data": this_record}
-        self.process_data(msg)
+      if self.timer:
+        self.timer.mark("received", name, scan, record)
+      with self.lock:
+        self.store(result)
     else:
       self.logger.debug("combine_data: %s received %s message", name,
                         result['type'])
-                        
+
+  def store(self, result):
+    """
+    put a DSP's spectrum in its scan buffer and emit the record if complete;
+    ``lock`` must be held
+    """
+    name = result['name']
+    scan = result['scan']
+    record = result["record"]
+    data = result["data"]
+    if record in self.partials.get(scan, {}):
+      self.late_arrival(result)
+      return
+    if scan in self.finished:
+      self.logger.warning("combine_data: %s scan %s record %s arrived after"
+                          " the scan finished", name, scan, record)
+      return
+    buf = self.scan_buffer(scan, data)
+    slot = buf.slot(record)
+    if buf.is_late(record):
+      # a newer record must never be evicted by an older one
+      self.logger.warning("combine_data: %s scan %s record %s dropped; its"
+                          " slot has been taken by a newer record", name,
+                          scan, record)
+      return
+    if buf.record[slot] not in (0, record):
+      # the ring moves on; the older record goes out as it is
+      self.logger.warning("combine_data: scan %s record %s emitted without %s"
+                          " to make room for record %s", scan,
+                          buf.record[slot], buf.missing(slot), record)
+      self.emit(buf, slot)
+    complete = buf.store(name, record, data, result["time"])
+    if self.timer:
+      self.timer.mark("stored", name, scan, record)
+    self.hotlog.debug("combine_data: %s %s %s stored %s",
+                      name, scan, hotlog.LazyTime("gmt"), record)
+    # Are all the ROACHs' data in the buffer? If so, output 
+    if complete:
+      self.emit(buf, slot)
+
+  def emit(self, buf, slot):
+    """
+    pass the record in a slot to ``process_data`` and free the slot
+
+    Missing spectra are filled in and remembered in ``partials``.  ``lock``
+    must be held.
+    """
+    scan = buf.scan
+    record = buf.record[slot]
+    missing = buf.missing(slot)
+    if missing:
+      buf.fill_missing(slot)
+      self.partials.setdefault(scan, {})[record] = set(missing)
+      while len(self.partials) > self.max_scans + 1:
+        self.partials.popitem(last=False)
+    this_record, this_time = buf.views(slot)
+    msg = {"scan": scan, "record": record, "time": this_time,
+           "type": "data", "data": this_record, "missing": missing}
+    self.process_data(msg)
+    buf.clear(slot)
+    buf.emitted += 1
+    if self.records_per_scan and buf.emitted >= self.records_per_scan:
+      if self.scans.pop(scan, None) is not None:
+        self.finished.append(scan)
+
+  def late_arrival(self, result):
+    """
+    handle a spectrum for a record which was emitted without it
+    """
+    name = result['name']
+    scan = result['scan']
+    record = result["record"]
+    missing = self.partials[scan][record]
+    missing.discard(name)
+    if not missing:
+      del self.partials[scan][record]
+    if self.late_policy == "patch":
+      self.logger.info("late_arrival: patching scan %s record %s with %s",
+                       scan, record, name)
+      self.process_patch({"scan": scan, "record": record, "type": "patch",
+                          "time": {name: result["time"]},
+                          "data": {name: result["data"]}})
+    else:
+      self.logger.warning("late_arrival: dropped %s scan %s record %s",
+                          name, scan, record)
+
+  def process_patch(self, patch):
+    """
+    what to do with a late spectrum; provided by subclass
+    """
+    self.logger.info("process_patch: no destination specified for patch of"
+                     " scan %s record %s", patch["scan"], patch["record"])
+
   def process_data(self, data):
     """
     what to do with the data; provided by subclass
+
+    The spectra in ``data`` are views into the combiner's buffer which will be
+    reused once this returns, so they must be used or copied here.
     """
     self.logger.info("process_data:"
                      " no destination specified for data %s", data.keys())
-
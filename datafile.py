@@ -0,0 +1,394 @@
+"""
+HDF5 data files written in the background
+
+Both writers here take records on a queue and write them to HDF5 from their
+own thread, so acquisition never waits for the disk.  Records are collected
+in memory and written in blocks every ``flush_records`` records or
+``flush_interval`` seconds.
+
+A ``RecordWriter`` takes records from one ROACH reader.  The layout is::
+
+  /                 attrs: firmware registers which do not change
+    scan_001        attrs: registers which do not change during the scan
+      spectra       (records x channels), chunked and resizable
+      record        record numbers
+      time          record times
+      <register>    one value per record for registers which change
+
+When the data written to a file exceed ``max_size`` bytes a new file is
+started; the scan carries on in a new group of the same name in the new file.
+A scan number which is used again, after the scans were reset, gets a new
+group, e.g. scan_001_2.
+The spectra put on its queue are not copied, so they must not be changed
+afterwards.
+
+A ``CombinedWriter`` takes the combined records of all the ROACHs and keeps
+them in one file laid out for contiguous reading::
+
+  /                 attrs: roaches (names in order)
+    scan            (scans,) scan numbers
+    spectra         (scans x records x roaches x channels)
+    time            (scans x records x roaches)
+
+Records which never arrive are left as NaN.  Its ``put`` copies the spectra,
+since the combiner reuses its buffers.  A record with only some of the ROACHs,
+like a combiner patch, writes only those.  After ``begin_scan`` a scan number
+which is already in the file gets a new index along the scan axis, so 'scan'
+may hold a number more than once.
+"""
+import h5py
+import logging
+import numpy
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class BackgroundWriter(threading.Thread):
+  """
+  Thread which collects queued items and writes them in blocks
+
+  Subclasses provide ``open_file``, ``collect(item)`` and ``write()``, and
+  keep ``n_pending``, the number of records collected but not written.
+  """
+  def __init__(self, name, flush_records=16, flush_interval=5.0):
+    threading.Thread.__init__(self, name=name)
+    self.flush_records = flush_records
+    self.flush_interval = flush_interval
+    self.queue = queue.Queue()
+    self.file = None
+    self.n_pending = 0
+    self.daemon = True
+
+  def close(self):
+    """
+    write what is left, close the file and end the thread
+    """
+    self.queue.put(None)
+    self.join()
+
+  def run(self):
+    """
+    thread loop
+    """
+    last_flush = time.time()
+    while True:
+      try:
+        item = self.queue.get(timeout=self.flush_interval)
+      except queue.Empty:
+        item = ()
+      if item is None:
+        break
+      elif item:
+        self.collect(item)
+      if self.n_pending >= self.flush_records or \
+         time.time() - last_flush >= self.flush_interval:
+        self.flush()
+        last_flush = time.time()
+    self.flush()
+    self.file.close()
+    self.logger.info("run: %s closed", self.filename)
+
+  def flush(self):
+    """
+    write the collected records
+    """
+    if self.n_pending:
+      self.write()
+      self.file.flush()
+    self.n_pending = 0
+
+  def _append(self, group, name, values, first, last):
+    """
+    grow a dataset and write rows first:last
+    """
+    dataset = group[name]
+    dataset.resize(last, axis=0)
+    dataset[first:last] = values
+
+class RecordWriter(BackgroundWriter):
+  """
+  Writes the records of one spectrometer to HDF5 files
+
+  Attributes::
+    basename   - files are named basename_001.hdf5, basename_002.hdf5, ...
+    file       - the h5py.File being written
+    filename   - name of the current file
+    logger     - logging.Logger instance
+    max_size   - bytes of data after which a new file is started
+    queue      - queue of things to write
+  """
+  def __init__(self, basename, file_attrs={}, max_size=1e9, flush_records=16,
+                     flush_interval=5.0, chunk_records=8, compression=None):
+    """
+    open the first file and start the thread
+
+    @param basename : path and name of the files without number or extension
+    @type  basename : str
+
+    @param file_attrs : attributes of the top level of each file
+    @type  file_attrs : dict
+
+    @param max_size : bytes of data per file
+    @type  max_size : float
+
+    @param flush_records : number of records to collect before writing
+    @type  flush_records : int
+
+    @param flush_interval : longest time in seconds between writes
+    @type  flush_interval : float
+
+    @param chunk_records : records per HDF5 chunk
+    @type  chunk_records : int
+
+    @param compression : h5py compression filter, e.g. "gzip"
+    @type  compression : str
+    """
+    BackgroundWriter.__init__(self, "writer-"+basename.split("/")[-1],
+                              flush_records=flush_records,
+                              flush_interval=flush_interval)
+    self.logger = logging.getLogger(logger.name+".RecordWriter")
+    self.basename = basename
+    self.file_attrs = file_attrs
+    self.max_size = max_size
+    self.chunk_records = chunk_records
+    self.compression = compression
+    self.file_number = 0
+    self.scan_attrs = {}
+    self.group_names = {}
+    self.used_names = set()
+    self.pending = {}
+    self.open_file()
+    self.start()
+
+  def begin_scan(self, scan, attrs):
+    """
+    give the attributes of a new scan
+    """
+    self.queue.put(("scan", scan, attrs))
+
+  def put(self, msg, registers={}):
+    """
+    queue a record for writing
+
+    @param msg : reader message with 'scan', 'record', 'time' and 'data'
+    @type  msg : dict
+
+    @param registers : register values for this record
+    @type  registers : dict
+    """
+    self.queue.put(("record", msg, registers))
+
+  def collect(self, item):
+    """
+    keep a record or the attributes of a scan
+    """
+    if item[0] == "scan":
+      scan = item[1]
+      name = "scan_%03d" % scan
+      repeat = 1
+      while name in self.used_names:
+        repeat += 1
+        name = "scan_%03d_%d" % (scan, repeat)
+      self.group_names[scan] = name
+      self.scan_attrs[name] = item[2]
+    else:
+      msg, registers = item[1:]
+      name = self.group_name(msg["scan"])
+      self.pending.setdefault(name, []).append((msg, registers))
+      self.n_pending += 1
+
+  def group_name(self, scan):
+    """
+    name of the group for the present scan with this number
+    """
+    name = self.group_names.get(scan, "scan_%03d" % scan)
+    self.used_names.add(name)
+    return name
+
+  def open_file(self):
+    """
+    start the next file
+    """
+    if self.file:
+      self.file.close()
+      self.logger.info("open_file: %s closed", self.filename)
+    self.file_number += 1
+    self.filename = "%s_%03d.hdf5" % (self.basename, self.file_number)
+    self.file = h5py.File(self.filename, "w")
+    for key, value in self.file_attrs.items():
+      self.file.attrs[key] = value
+    self.bytes_written = 0
+    self.logger.info("open_file: writing %s", self.filename)
+
+  def scan_group(self, name, num_chan, dtype):
+    """
+    get the group for a scan, creating it if needed
+    """
+    if name in self.file:
+      return self.file[name]
+    group = self.file.create_group(name)
+    for key, value in self.scan_attrs.get(name, {}).items():
+      group.attrs[key] = value
+    group.create_dataset("spectra", shape=(0, num_chan), dtype=dtype,
+                         maxshape=(None, num_chan),
+                         chunks=(self.chunk_records, num_chan),
+                         compression=self.compression)
+    group.create_dataset("record", shape=(0,), dtype="i4", maxshape=(None,))
+    group.create_dataset("time", shape=(0,), dtype="f8", maxshape=(None,))
+    return group
+
+  def write(self):
+    """
+    write the collected records, one block per scan
+    """
+    for name, records in self.pending.items():
+      spectra = numpy.stack([msg["data"] for msg, registers in records])
+      group = self.scan_group(name, spectra.shape[1], spectra.dtype)
+      first = group["spectra"].shape[0]
+      last = first + len(records)
+      self._append(group, "spectra", spectra, first, last)
+      self._append(group, "record",
+                   [msg["record"] for msg, registers in records], first, last)
+      self._append(group, "time",
+                   [msg["time"] for msg, registers in records], first, last)
+      for key in records[0][1]:
+        if key not in group:
+          group.create_dataset(key, shape=(first,), maxshape=(None,),
+                               dtype="f8", fillvalue=numpy.nan)
+        self._append(group, key,
+                     [registers.get(key, numpy.nan)
+                      for msg, registers in records], first, last)
+      self.bytes_written += spectra.nbytes
+    self.pending = {}
+
+  def flush(self):
+    """
+    write the collected records and start a new file if this one is full
+    """
+    BackgroundWriter.flush(self)
+    if self.bytes_written >= self.max_size:
+      self.open_file()
+
+class CombinedWriter(BackgroundWriter):
+  """
+  Writes the combined records of all the ROACHs to one HDF5 file
+
+  Attributes::
+    filename   - name of the file
+    file       - the h5py.File being written
+    logger     - logging.Logger instance
+    names      - ROACH names in the order of the roach axis
+    n_scans    - length of the scan axis
+    queue      - queue of records to write
+    scans      - index along the scan axis of the present scan with each
+                 number
+  """
+  def __init__(self, filename, names, num_chan, flush_records=16,
+                     flush_interval=5.0, compression=None):
+    """
+    create the file and start the thread
+
+    @param filename : name of the HDF5 file
+    @type  filename : str
+
+    @param names : ROACH names in order
+    @type  names : list of str
+
+    @param num_chan : number of channels per spectrum
+    @type  num_chan : int
+
+    @param compression : h5py compression filter, e.g. "gzip"
+    @type  compression : str
+    """
+    BackgroundWriter.__init__(self, "combined-writer",
+                              flush_records=flush_records,
+                              flush_interval=flush_interval)
+    self.logger = logging.getLogger(logger.name+".CombinedWriter")
+    self.filename = filename
+    self.names = list(names)
+    self.num_chan = num_chan
+    self.compression = compression
+    self.scans = {}
+    self.n_scans = 0
+    self.new_scans = []
+    self.pending = []
+    self.open_file()
+    self.start()
+
+  def open_file(self):
+    """
+    create the file and its datasets
+    """
+    n_roach = len(self.names)
+    self.file = h5py.File(self.filename, "w")
+    self.file.attrs["roaches"] = [name.encode("utf-8") for name in self.names]
+    self.file.create_dataset("scan", shape=(0,), dtype="i4", maxshape=(None,))
+    self.file.create_dataset("spectra", shape=(0, 0, n_roach, self.num_chan),
+                             dtype="f4", fillvalue=numpy.nan,
+                             maxshape=(None, None, n_roach, self.num_chan),
+                             chunks=(1, 1, n_roach, self.num_chan),
+                             compression=self.compression)
+    self.file.create_dataset("time", shape=(0, 0, n_roach), dtype="f8",
+                             fillvalue=numpy.nan,
+                             maxshape=(None, None, n_roach),
+                             chunks=(1, 1024, n_roach))
+    self.logger.info("open_file: writing %s", self.filename)
+
+  def begin_scan(self, scan):
+    """
+    records of this scan number which follow go to a new scan index
+    """
+    self.queue.put(("scan", scan))
+
+  def put(self, msg):
+    """
+    queue a combined record for writing; the spectra are copied
+    """
+    names = [name for name in self.names if name in msg["data"]]
+    if len(names) == len(self.names):
+      index = slice(None)
+    else:
+      index = [self.names.index(name) for name in names]
+    spectra = numpy.stack([msg["data"][name] for name in names])
+    times = [msg["time"][name] for name in names]
+    self.queue.put(("record", msg["scan"], msg["record"], index, times,
+                    spectra))
+
+  def collect(self, item):
+    """
+    keep a record, or start a scan
+    """
+    if item[0] == "scan":
+      self.scans.pop(item[1], None)
+      return
+    scan, record, index, times, spectra = item[1:]
+    if scan not in self.scans:
+      self.scans[scan] = self.n_scans
+      self.n_scans += 1
+      self.new_scans.append(scan)
+    self.pending.append((self.scans[scan], record, index, times, spectra))
+    self.n_pending += 1
+
+  def write(self):
+    """
+    grow the datasets as needed and write the collected records
+    """
+    if self.new_scans:
+      first = self.file["scan"].shape[0]
+      self._append(self.file, "scan", self.new_scans, first,
+                   first + len(self.new_scans))
+      self.new_scans = []
+    spectra_ds = self.file["spectra"]
+    time_ds = self.file["time"]
+    n_records = max(spectra_ds.shape[1],
+                    max(item[1] for item in self.pending))
+    shape = (self.n_scans, n_records)
+    if spectra_ds.shape[:2] != shape:
+      spectra_ds.resize(shape + spectra_ds.shape[2:])
+      time_ds.resize(shape + time_ds.shape[2:])
+    for row, record, index, times, spectra in self.pending:
+      spectra_ds[row, record-1, index] = spectra
+      time_ds[row, record-1, index] = times
+    self.pending = []
@@ -0,0 +1,250 @@
+"""
+Spectra for display by web clients
+
+The dashboard asks the back end for the latest spectrum of every ROACH,
+averaged over some number of channels, as a Google Charts table: a list of
+lists whose first row is the titles and whose first column is frequency.
+
+``SpectrumDisplay`` keeps such tables ready.  Each combined record is copied
+into a ``SpectrumPyramid``, which holds the spectra averaged over 1, 4, 16,
+64 and 256 channels, each level computed from the one below it.  The
+averaged, optionally logarithmic, tables are then updated in place from the
+nearest pyramid level.  The frequency column for each averaging factor is
+computed once.  The list of lists is made at the first request after a
+record arrives and then reused until the next record.
+
+To zoom in, ``SpectrumDisplay.window`` returns any frequency range at about a
+requested number of points, taken from the coarsest level which has enough
+channels in that range, so a client never needs the full 32K channels.
+"""
+import logging
+import numbers
+import numpy
+import threading
+
+import MonitorControl.BackEnds as BE
+
+logger = logging.getLogger(__name__)
+
+class SpectrumPyramid(object):
+  """
+  The latest spectra averaged over several numbers of channels
+
+  Attributes::
+    factors - averaging factors, smallest first; each divides the next
+    levels  - (ROACHs x channels/factor) array for each factor
+  """
+  factors = (1, 4, 16, 64, 256)
+
+  def __init__(self, n_roach, num_chan, factors=factors):
+    self.factors = tuple(sorted(factors))
+    if self.factors[0] != 1:
+      raise ValueError("the first pyramid level must be full resolution")
+    for finer, coarser in zip(self.factors, self.factors[1:]+(num_chan,)):
+      if coarser % finer:
+        raise ValueError("%d does not divide %d" % (finer, coarser))
+    self.levels = {factor: numpy.zeros((n_roach, num_chan//factor))
+                   for factor in self.factors}
+
+  def update(self, index, spectrum):
+    """
+    put a spectrum into the pyramid
+
+    @param index : ROACH index
+    @type  index : int
+
+    @param spectrum : full resolution spectrum
+    @type  spectrum : 1D array
+    """
+    self.levels[1][index] = spectrum
+    for finer, coarser in zip(self.factors, self.factors[1:]):
+      row = self.levels[coarser][index]
+      self.levels[finer][index].reshape(row.shape[0], coarser//finer).mean(
+                                                                axis=1, out=row)
+
+  def level_for(self, squish):
+    """
+    the coarsest level from which spectra averaged over ``squish`` channels
+    can be made
+    """
+    return max(factor for factor in self.factors if squish % factor == 0)
+
+class SpectrumDisplay(object):
+  """
+  Latest spectra from all the ROACHs in Google Charts form
+
+  Attributes::
+    latest  - (ROACHs x channels) array with the latest spectra
+    logger  - logging.Logger instance
+    names   - ROACH names in column order
+    pyramid - SpectrumPyramid with the latest spectra
+    record  - record number of the latest spectra
+    scan    - scan number of the latest spectra
+    tables  - (points x ROACHs+1) array for each (squish, dolog) requested
+    titles  - column titles
+  """
+  def __init__(self, names, bandwidth, num_chan):
+    """
+    @param names : ROACH names in the order of the table columns
+    @type  names : list of str
+
+    @param bandwidth : spectrometer bandwidth in MHz
+    @type  bandwidth : float
+
+    @param num_chan : number of channels in a spectrum
+    @type  num_chan : int
+    """
+    self.logger = logging.getLogger(logger.name+".SpectrumDisplay")
+    self.names = list(names)
+    self.titles = ["Frequency"] + self.names
+    self.bandwidth = bandwidth
+    self.num_chan = num_chan
+    self.pyramid = SpectrumPyramid(len(self.names), num_chan)
+    self.latest = None
+    self.scan = None
+    self.record = None
+    self.tables = {}
+    self._freqs = {}
+    self._lists = {}
+    self._lock = threading.Lock()
+
+  def freqs(self, squish):
+    """
+    frequency column for an averaging factor
+    """
+    if squish not in self._freqs:
+      self._freqs[squish] = BE.get_freq_array(self.bandwidth,
+                                              self.num_chan//squish)
+    return self._freqs[squish]
+
+  def update(self, msg):
+    """
+    take the spectra from a combined record
+
+    @param msg : combined record with spectra keyed by ROACH name
+    @type  msg : dict
+    """
+    with self._lock:
+      for index, name in enumerate(self.names):
+        self.pyramid.update(index, msg["data"][name])
+      self.latest = self.pyramid.levels[1]
+      self.scan = msg["scan"]
+      self.record = msg["record"]
+      for key, table in self.tables.items():
+        self._fill(key, table)
+      self._lists.clear()
+
+  def check_squish(self, squish):
+    """
+    raise ValueError unless ``squish`` is a whole number of channels which
+    divides the spectrum
+    """
+    if isinstance(squish, bool) or not isinstance(squish, numbers.Integral):
+      raise ValueError("squish must be an integer, not %r" % (squish,))
+    if squish < 1 or squish > self.num_chan or self.num_chan % squish:
+      raise ValueError("squish %d does not divide %d channels"
+                       % (squish, self.num_chan))
+
+  def _fill(self, key, table):
+    """
+    recompute the data columns of a table from the pyramid
+    """
+    squish, dolog = key
+    npts = table.shape[0]
+    factor = self.pyramid.level_for(squish)
+    level = self.pyramid.levels[factor]
+    for index in range(len(self.names)):
+      column = table[:, index+1]
+      level[index].reshape(npts, squish//factor).mean(axis=1, out=column)
+      if dolog:
+        # log10 of the positive values; the others become 0
+        positive = column > 0
+        numpy.log10(column, out=column, where=positive)
+        column[~positive] = 0
+
+  def get(self, squish=16, dolog=True):
+    """
+    the latest spectra as a Google Charts table
+
+    A table is allocated the first time a ``squish``, ``dolog`` combination is
+    requested and kept up to date after that.  ``squish`` must divide the
+    number of channels.
+
+    @param squish : number of channels to average
+    @type  squish : int
+
+    @param dolog : return log10 of data if True; non-positive values become 0
+    @type  dolog : bool
+
+    @return: dict with 'scan', 'record' and 'table'
+    """
+    self.check_squish(squish)
+    squish = int(squish)
+    key = (squish, bool(dolog))
+    with self._lock:
+      if key not in self.tables:
+        npts = self.num_chan//squish
+        table = numpy.zeros((npts, len(self.names)+1))
+        table[:, 0] = self.freqs(squish)
+        if self.latest is not None:
+          self._fill(key, table)
+        # kept only once it has been filled, so a bad table cannot break
+        # update()
+        self.tables[key] = table
+      if key not in self._lists:
+        self._lists[key] = [self.titles] + self.tables[key].tolist()
+      return {"scan":   self.scan,
+              "record": self.record,
+              "table":  self._lists[key]}
+
+  def window(self, fmin, fmax, width, dolog=True):
+    """
+    a frequency range of the latest spectra at about ``width`` points
+
+    The data come from the coarsest pyramid level with at least ``width``
+    points in the range and are averaged further if there are more than twice
+    that many.  Frequencies are those of the first channel of each point, as
+    in ``get()``.
+
+    @param fmin : lowest frequency in MHz
+    @type  fmin : float
+
+    @param fmax : highest frequency in MHz
+    @type  fmax : float
+
+    @param width : number of points wanted, e.g. the plot width in pixels
+    @type  width : int
+
+    @return: dict with 'scan', 'record', 'squish' and 'table'
+    """
+    chan_width = self.bandwidth/self.num_chan
+    start = max(0, int(numpy.floor(fmin/chan_width)))
+    stop = min(self.num_chan, int(numpy.ceil(fmax/chan_width)) + 1)
+    if stop <= start:
+      raise ValueError("no channels between %s and %s MHz" % (fmin, fmax))
+    width = max(1, int(width))
+    with self._lock:
+      factor = 1
+      for candidate in self.pyramid.factors:
+        if (stop - start)//candidate >= width:
+          factor = candidate
+      first = start//factor
+      last = -(-stop//factor)
+      data = self.pyramid.levels[factor][:, first:last]
+      # average further if this level has more than twice the points wanted
+      group = max(1, data.shape[1]//width) if data.shape[1] > 2*width else 1
+      npts = data.shape[1]//group
+      data = data[:, :npts*group].reshape(len(self.names), npts, group).mean(
+                                                                        axis=2)
+      scan, record = self.scan, self.record
+    squish = factor*group
+    if dolog:
+      positive = data > 0
+      data = numpy.log10(data, out=numpy.zeros_like(data), where=positive)
+    table = numpy.empty((npts, len(self.names)+1))
+    table[:, 0] = (first*factor + numpy.arange(npts)*squish)*chan_width
+    table[:, 1:] = data.T
+    return {"scan":   scan,
+            "record": record,
+            "squish": squish,
+            "table":  [self.titles] + table.tolist()}
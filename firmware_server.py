@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
+import collections
+import copy
+import hashlib
 import logging
 import os
+import pickle
 import Pyro5.api
 
-from openpyxl import load_workbook
-from openpyxl.reader.excel import InvalidFileException
-import support.excel
+# openpyxl and support.excel are imported only when the spreadsheet is read
 
 module_logger = logging.getLogger(__name__)
 
@@ -13,6 +15,111 @@ modulepath = os.path.dirname(os.path.abspath(__file__))
 module_logger.debug("path to this module: %s", modulepath)
 paramfile = "model_params.xlsx"
 module_logger.debug("model parameter file: %s", paramfile)
+cache_version = 2
+
+class Bitfield(collections.namedtuple("Bitfield", ["register", "name", "bits",
+                                       "msb", "lsb", "purpose", "values"])):
+  """
+  One field of a firmware register
+
+  ``bits`` is the text from the spreadsheet, e.g. "5:0" or "31", and ``msb``
+  and ``lsb`` are the bit numbers, or None if ``bits`` is not a bit range.
+  """
+  __slots__ = ()
+
+  @property
+  def width(self):
+    if self.lsb is None:
+      return None
+    return self.msb - self.lsb + 1
+
+  @property
+  def mask(self):
+    if self.lsb is None:
+      return None
+    return ((1 << self.width) - 1) << self.lsb
+
+  def extract(self, value):
+    """
+    value of this field in a register value
+    """
+    if self.lsb is None:
+      return None
+    return (value >> self.lsb) & ((1 << self.width) - 1)
+
+Register = collections.namedtuple("Register", ["name", "direction", "fields"])
+
+def parse_bits(bits):
+  """
+  Bit range text from the spreadsheet to (text, msb, lsb)
+  """
+  if isinstance(bits, float) and bits.is_integer():
+    bits = int(bits)
+  bits = str(bits)
+  try:
+    if ":" in bits:
+      msb, lsb = [int(bit) for bit in bits.split(":")]
+    else:
+      msb = lsb = int(bits)
+  except ValueError:
+    return bits, None, None
+  return bits, msb, lsb
+
+class RegisterMap(object):
+  """
+  Register table for one firmware sheet
+
+  Attributes::
+    fields    - Bitfield keyed by (register name, field name)
+    registers - Register keyed by name, in sheet order
+  """
+  def __init__(self, registers):
+    self.registers = registers
+    self.fields = {}
+    self._by_name = {}
+    for register in registers.values():
+      for field in register.fields:
+        self.fields[(register.name, field.name)] = field
+        self._by_name.setdefault(field.name, []).append(field)
+
+  def field(self, name, register=None):
+    """
+    Look up a bitfield by name
+
+    A field name used in more than one register needs the register name.
+    """
+    if register is not None:
+      return self.fields[(register, name)]
+    fields = self._by_name[name]
+    if len(fields) > 1:
+      raise KeyError("%s is in registers %s" %
+                     (name, [field.register for field in fields]))
+    return fields[0]
+
+  def decode(self, register, value):
+    """
+    Split a register value into its named fields
+    """
+    return {field.name: field.extract(value)
+            for field in self.registers[register].fields
+            if field.lsb is not None}
+
+  def as_dict(self):
+    """
+    The dict of dicts that ``FirmwareServer.parse_registers`` returns
+    """
+    register = {}
+    for reg in self.registers.values():
+      register[reg.name] = {'direction': reg.direction}
+      for field in reg.fields:
+        if field.bits == "31:0":
+          register[reg.name]['bits'] = {field.bits: None}
+          continue
+        entry = {'name': str(field.name), 'purpose': str(field.purpose)}
+        if field.values:
+          entry['values'] = str(field.values)
+        register[reg.name].setdefault('bits', {})[field.bits] = entry
+    return register
 
 @Pyro5.api.expose
 class FirmwareServer():
@@ -20,13 +127,23 @@ class FirmwareServer():
   Serves information about firmware and their boffiles.
 
   Public attributes::
-    firmware_wb - Excel spreadsheet with data on firmware
+    cachefile   - file with the data compiled from the spreadsheet
+    firmware_wb - Excel spreadsheet with data on firmware; None until needed
     logger      - class logger
     paramfile   - name of Excel spreadsheet
     parampath   - path to Excel spreadsheet
+    param_columns - column numbers of the 'Parameters' sheet by name
+    param_rows  - row numbers of the 'Parameters' sheet by firmware key
     param_ws    - 'Parameters' sheet
     register    - dict of dicts of register data
-    sheetnames  - sheet names in Excel spreadsheet
+    sheet_names - sheet names in Excel spreadsheet
+
+  The summaries of all the firmware in the 'Parameters' sheet and any register
+  maps which have been parsed are kept in ``cachefile``, a pickle tagged with
+  the SHA1 hash of the spreadsheet.  While the hash matches, the spreadsheet
+  is not opened at all.  Otherwise it is read, indexed by column name and
+  firmware key, and the cache is rewritten.  If the spreadsheet file changes
+  while the server is running it is checked again at the next request.
   """
   def __init__(self, parampath=modulepath, paramfile=paramfile):
     """
@@ -34,22 +151,109 @@ class FirmwareServer():
     """
     self.parampath = parampath
     self.paramfile = paramfile
+    self.cachefile = os.path.join(parampath,
+                                  os.path.splitext(paramfile)[0]+".pickle")
     self.logger = logging.getLogger(module_logger.name+".FirmwareServer")
     self.logger.debug("__init__: initialized")
-    self._open_parameter_spreadsheet()
+    self._load()
+
+  @property
+  def spreadsheet(self):
+    return os.path.join(self.parampath,self.paramfile)
+
+  def _load(self):
+    """
+    Get the firmware data from the cache file or, if that is stale, from the
+    spreadsheet
+    """
+    self._mtime = os.path.getmtime(self.spreadsheet)
+    with open(self.spreadsheet, "rb") as xlsx:
+      digest = hashlib.sha1(xlsx.read()).hexdigest()
+    cache = self._read_cache()
+    if cache and cache["hash"] == digest:
+      self.logger.debug("_load: using %s", self.cachefile)
+      self._cache = cache
+      self.sheet_names = cache["sheet_names"]
+      self._summaries = cache["summaries"]
+      self.firmware_wb = None
+      self.param_ws = None
+    else:
+      self.logger.info("_load: compiling %s", self.paramfile)
+      self._open_parameter_spreadsheet()
+      self._summaries = {}
+      for key in self.param_rows:
+        if key in (None, 'key'):
+          continue
+        try:
+          self._summaries[key] = self._make_summary(key)
+        except Exception:
+          self.logger.warning("_load: no summary for %s", key, exc_info=True)
+      self._cache = {"version":     cache_version,
+                     "hash":        digest,
+                     "sheet_names": self.sheet_names,
+                     "summaries":   self._summaries,
+                     "registers":   {}}
+      self._write_cache()
+
+  def _read_cache(self):
+    """
+    Read the cache file
+
+    A cache pickled by other code may name modules or classes which no
+    longer exist; like a truncated file, it is treated as stale.
+
+    @return: dict, or None if there is no usable cache
+    """
+    try:
+      with open(self.cachefile, "rb") as cache_file:
+        cache = pickle.load(cache_file)
+    except FileNotFoundError:
+      self.logger.debug("_read_cache: no cache in %s", self.cachefile)
+      return None
+    except (OSError, EOFError, pickle.UnpicklingError, ImportError,
+            AttributeError):
+      self.logger.info("_read_cache: stale cache in %s", self.cachefile,
+                       exc_info=True)
+      return None
+    if not isinstance(cache, dict) or cache.get("version") != cache_version:
+      return None
+    return cache
+
+  def _write_cache(self):
+    """
+    Write the cache file
+    """
+    tempfile = self.cachefile+".tmp"
+    try:
+      with open(tempfile, "wb") as cache_file:
+        pickle.dump(self._cache, cache_file, pickle.HIGHEST_PROTOCOL)
+      os.replace(tempfile, self.cachefile)
+    except OSError:
+      self.logger.warning("_write_cache: cannot write %s", self.cachefile,
+                          exc_info=True)
+
+  def _workbook(self):
+    """
+    Open the spreadsheet if it has not been opened yet
+    """
+    if self.firmware_wb is None:
+      self._open_parameter_spreadsheet()
+    return self.firmware_wb
 
   def _open_parameter_spreadsheet(self):
     """
     Get the firmware summary worksheet
     """
+    from openpyxl.reader.excel import InvalidFileException
+    import support.excel
     # self.logger.debug("_open_parameter_spreadsheet: for %s",
     #   self.parampath+self.paramfile)
     self.logger.debug("_open_parameter_spreadsheet: for {}".format(
-      os.path.join(self.parampath,self.paramfile)
+      self.spreadsheet
     ))
     try:
     #   self.firmware_wb = load_workbook(self.parampath+self.paramfile)
-      self.firmware_wb = support.excel.load_workbook(os.path.join(self.parampath,self.paramfile))
+      self.firmware_wb = support.excel.load_workbook(self.spreadsheet)
     except IOError as details:
       self.logger.error(
       "_open_parameter_spreadsheet: loading spreadsheet failed with IO error.",
@@ -69,6 +273,7 @@ class FirmwareServer():
     self.logger.debug("_open_parameter_spreadsheet: sheet names: %s",
                       str(self.sheet_names))
     self.param_ws = self.firmware_wb.get_sheet_by_name('Parameters')
+    self._index_parameters()
     #column_names = get_column_names(self.param_ws)
     #self.logger.debug("_open_parameter_spreadsheet: columns found:")
     #for name in column_names.keys():
@@ -85,45 +290,68 @@ class FirmwareServer():
 
     @return: list of entries in the 'key' or 'Register' column
     """
+    import support.excel
+    workbook = self._workbook()
     if sheet == '':
       sheet = self.param_ws
       self.logger.debug('get_keys: checking sheet %s', sheet)
       keys = support.excel.get_column(sheet,'key')
     else:
-      sheet = self.firmware_wb.get_sheet_by_name(sheet)
+      sheet = workbook.get_sheet_by_name(sheet)
       keys = support.excel.get_column(sheet,'Register')
     return keys
 
+  def _index_parameters(self):
+    """
+    Index the 'Parameters' sheet by column name and by firmware key
+    """
+    self.param_columns = {}
+    for number, cell in enumerate(next(self.param_ws.iter_rows(1, 1)), 1):
+      self.param_columns[cell.value] = number
+    self.logger.debug("_index_parameters: column name dict: %s",
+                      self.param_columns)
+    self.param_rows = {}
+    for number, row in enumerate(
+                     self.param_ws.iter_rows(1, self.param_ws.max_row), 1):
+      self.param_rows[row[0].value] = number
+    self.logger.debug("_index_parameters: row name dict: %s", self.param_rows)
+
+  def _check_spreadsheet(self):
+    """
+    Re-read the spreadsheet if the file has changed since it was read
+    """
+    mtime = os.path.getmtime(self.spreadsheet)
+    if mtime != self._mtime:
+      self.logger.info("_check_spreadsheet: %s changed; reloading",
+                       self.paramfile)
+      self._load()
+
   def firmware_summary(self,key):
     """
     Get the summary data for the designated firmware.
 
+    The summaries come from the cache or are made when the spreadsheet is
+    read; a copy is returned.
+
     @param key : item from first column of 'Parameters' sheet
 
     @return: dict with data from "Parameters" sheet row
     """
+    self._check_spreadsheet()
+    if key not in self._summaries:
+      self._summaries[key] = self._make_summary(key)
+    return copy.deepcopy(self._summaries[key])
+
+  def _make_summary(self,key):
+    """
+    Make the summary for the designated firmware from the 'Parameters' sheet
+    """
     summary = {}
-    self.logger.debug("firmware_summary: for %s", self.param_ws)
-    # Get the column names
-    # Create a dictionary keyed with column names
-    col_numbers = {}
-    number = 1
-    for col in self.param_ws.iter_cols(1, self.param_ws.max_column):
-      col_numbers[col[0].value] = number
-      number += 1
-    self.logger.debug("firmware summary: column name dict: %s", col_numbers)
-    # get the firmware key column
-    col_num = col_numbers['key']
-    self.logger.debug("firmware_summary: column for 'key' is %s", col_num)
-    # create a dictionary keyed with row names
-    row_numbers = {}
-    number = 1
-    for row in self.param_ws.iter_rows(1, self.param_ws.max_row):
-      row_numbers[row[0].value] = number
-      number += 1
-    self.logger.debug("firmware_summary: row name dict: %s", row_numbers)
+    self.logger.debug("_make_summary: for %s", key)
+    self._workbook()
+    col_numbers = self.param_columns
     # get selected firmware row
-    row_number = row_numbers[key]
+    row_number = self.param_rows[key]
     # now generate the summary
     summary['row'] = row_number
     bitstream = self.param_ws.cell(row=row_number, 
@@ -179,19 +407,54 @@ class FirmwareServer():
     summary['ADC types'] = ADC_type
     for index in range(4):
       gbe = 'gbe'+str(index)
-      self.logger.debug("firmware_summary: processing %s", gbe)
+      self.logger.debug("_make_summary: processing %s", gbe)
       column_name = gbe +' MAC'
-      self.logger.debug("firmware_summary: checking %s", column_name)
+      self.logger.debug("_make_summary: checking %s", column_name)
       gbe_MAC = self.param_ws.cell(row=row_number,
                                    column=col_numbers[column_name]).value
-      self.logger.debug("firmware_summary: MAC is %s", gbe_MAC)
+      self.logger.debug("_make_summary: MAC is %s", gbe_MAC)
       if gbe_MAC:
         summary[gbe+' MAC'] = gbe_MAC
         summary[gbe+' IP'] = self.param_ws.cell(row=row_number,
                                            column=col_numbers[gbe +' IP']).value
-    self.logger.debug("firmware_summary so far: %s", summary)
+    self.logger.debug("_make_summary: %s", summary)
     return summary
 
+  def register_map(self,sheetname):
+    """
+    Get the register table for a firmware sheet
+
+    The sheet is parsed in one pass, once; the table is kept in the cache.
+
+    @param sheetname : name of firmware data sheet
+    @type  sheetname : str
+
+    @return: RegisterMap
+    """
+    if sheetname in self._cache["registers"]:
+      return self._cache["registers"][sheetname]
+    sheet = self._workbook().get_sheet_by_name(sheetname)
+    self.logger.debug("register_map: parsing sheet %s", sheet)
+    registers = collections.OrderedDict()
+    current = None
+    for row in sheet.iter_rows(min_row=2, values_only=True):
+      row = (tuple(row) + (None,)*6)[:6]
+      reg_ID, direction, bits, name, purpose, values = row
+      if reg_ID:
+        current = str(reg_ID)
+        registers[current] = Register(current, str(direction), [])
+      elif bits is None or current is None:
+        # no new bit field in this row
+        continue
+      bits, msb, lsb = parse_bits(bits)
+      registers[current].fields.append(
+                        Bitfield(current, name, bits, msb, lsb, purpose, values))
+    for reg_ID, register in registers.items():
+      registers[reg_ID] = register._replace(fields=tuple(register.fields))
+    self._cache["registers"][sheetname] = RegisterMap(registers)
+    self._write_cache()
+    return self._cache["registers"][sheetname]
+
   def parse_registers(self,sheetname):
     """
     Get the register functions
@@ -201,33 +464,5 @@ class FirmwareServer():
 
     @return: dict of dicts with register data
     """
-    sheet = self.firmware_wb.get_sheet_by_name(sheetname)
-    self.logger.debug("parse_registers: parsing sheet %s", sheet)
-    self.register = {}
-    for row in sheet.rows[1:]:
-      # this means that index 0 is row 2, because we start with the second row
-      rowindex = sheet.rows[1:].index(row)
-      bits = str(row[2].value)
-      if row[0].value:
-        reg_ID = str(row[0].value)
-        #self.logger.debug("parse_registers: processing '%s'",reg_ID)
-        self.register[reg_ID] = {'direction': str(row[1].value)}
-        #self.logger.debug("parse_registers: bits = '%s'",bits)
-        if bits:
-          if bits != "31:0":
-            self.register[reg_ID]['bits'] = {bits:{'name':str(row[3].value)}}
-            self.register[reg_ID]['bits'][bits]['purpose'] = str(row[4].value)
-            if row[5].value:
-              self.register[reg_ID]['bits'][bits]['values'] = str(row[5].value)
-            prev_ID = reg_ID
-          else:
-            self.register[reg_ID]['bits'] = {bits: None}
-      else:
-        #self.logger.debug("parse_registers: row %s column 0 has no value", rowindex+2)
-        if bits != 'None':
-          self.register[prev_ID]['bits'][bits] = {'name':str(row[3].value)}
-          self.register[prev_ID]['bits'][bits]['purpose'] = str(row[4].value)
-          if row[5].value:
-            self.register[prev_ID]['bits'][bits]['values'] = \
-              str(row[5].value)
+    self.register = self.register_map(sheetname).as_dict()
     return self.register
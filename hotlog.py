@@ -0,0 +1,84 @@
+"""
+Cheap debug logging for the per-record code
+
+The acquisition and combining code logs several DEBUG lines for every record,
+each with a timestamp made by ``logtime()`` or ``nowgmt()``.  Those arguments
+were computed even when DEBUG was off.  Here::
+
+  LazyTime   - captures ``time.time()`` only; it is formatted when, and if,
+               the message is written
+  HotLogger  - wraps a logger for one stage; ``debug()`` does nothing unless
+               the stage is enabled and the logger is enabled for DEBUG
+
+The stages are enabled or disabled at run time with ``enable()``, which the
+server makes available over Pyro.  See ``apps/hotlog_benchmark.py`` for the
+cost per record.
+"""
+import datetime
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# whether the DEBUG messages of each stage are written
+flags = {"action":  True,
+         "combine": True,
+         "ADC":     True}
+
+def enable(stage, enabled=True):
+  """
+  turn the DEBUG messages of a stage on or off
+
+  @return: the flags of all the stages
+  """
+  if stage not in flags:
+    raise ValueError("unknown stage %s; stages are %s" % (stage, list(flags)))
+  flags[stage] = bool(enabled)
+  logger.info("enable: %s debug messages %s", stage,
+              "on" if enabled else "off")
+  return dict(flags)
+
+class LazyTime(object):
+  """
+  A timestamp which is formatted only when it is written
+
+  With ``style="clock"`` it prints like ``logtime()``, UTC HH:MM:SS.mmm; with
+  "gmt" it prints like ``nowgmt()``.
+  """
+  __slots__ = ("when", "style")
+
+  def __init__(self, style="clock"):
+    self.when = time.time()
+    self.style = style
+
+  def __str__(self):
+    if self.style == "clock":
+      return datetime.datetime.utcfromtimestamp(self.when).strftime(
+                                                             "%H:%M:%S.%f")[:-3]
+    return str(self.when + time.altzone)
+
+  __repr__ = __str__
+
+class HotLogger(object):
+  """
+  DEBUG messages for one stage of the per-record code
+
+  Attributes::
+    logger - the logging.Logger written to
+    stage  - key in ``flags``
+  """
+  __slots__ = ("logger", "stage")
+
+  def __init__(self, logger, stage):
+    if stage not in flags:
+      raise ValueError("unknown stage %s" % stage)
+    self.logger = logger
+    self.stage = stage
+
+  @property
+  def enabled(self):
+    return flags[self.stage] and self.logger.isEnabledFor(logging.DEBUG)
+
+  def debug(self, msg, *args):
+    if flags[self.stage] and self.logger.isEnabledFor(logging.DEBUG):
+      self.logger.debug(msg, *args)
@@ -0,0 +1,164 @@
+"""
+Bounded queues with overflow policies
+
+A ``BoundedQueue`` is a ``queue.Queue`` which holds at most ``maxsize`` items
+in memory.  What happens when another item is put depends on its policy::
+
+  block       - ``put()`` waits for room, which slows the producer down
+  drop-oldest - the oldest item is discarded to make room
+  spill       - items beyond ``maxsize`` are pickled to a file and read back,
+                in order, as the queue drains; they must survive pickling
+
+Each queue counts what it has done; see ``metrics()``.  ``task_done()`` and
+``join()`` work as usual, dropped items counting as done.
+"""
+import logging
+import pickle
+import queue
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+policies = ("block", "drop-oldest", "spill")
+
+class BoundedQueue(queue.Queue):
+  """
+  Queue with a memory limit and an overflow policy
+
+  Attributes::
+    dropped    - number of items discarded
+    high_water - largest number of items held
+    limit      - most items held in memory
+    logger     - logging.Logger instance
+    name       - name for logging and metrics
+    policy     - one of ``policies``
+    puts       - number of items put
+    spilled    - number of items written to the spill file
+  """
+  def __init__(self, maxsize=64, policy="block", spill_dir=None,
+                     name="queue"):
+    """
+    @param maxsize : most items in memory
+    @type  maxsize : int
+
+    @param policy : "block", "drop-oldest" or "spill"
+    @type  policy : str
+
+    @param spill_dir : directory for the spill file; default: system temp
+    @type  spill_dir : str
+    """
+    if policy not in policies:
+      raise ValueError("unknown queue policy %s" % policy)
+    if maxsize < 1:
+      raise ValueError("a bounded queue needs maxsize of at least 1")
+    # queue.Queue blocks only for the "block" policy
+    queue.Queue.__init__(self, maxsize if policy == "block" else 0)
+    self.logger = logging.getLogger(logger.name+".BoundedQueue")
+    self.name = name
+    self.limit = maxsize
+    self.policy = policy
+    self.spill_dir = spill_dir
+    self.puts = 0
+    self.high_water = 0
+    self.dropped = 0
+    self.spilled = 0
+    self._spill_file = None
+    self._spill_count = 0
+    self._read_pos = 0
+    self._write_pos = 0
+
+  # these are called by queue.Queue with the mutex held
+
+  def _qsize(self):
+    return len(self.queue) + self._spill_count
+
+  def _put(self, item):
+    self.puts += 1
+    if self.policy == "drop-oldest" and len(self.queue) >= self.limit:
+      self.queue.popleft()
+      self.dropped += 1
+      # the dropped item will never be task_done()
+      self.unfinished_tasks -= 1
+      if self.dropped == 1 or self.dropped % 100 == 0:
+        self.logger.warning("_put: %s full; %d items dropped", self.name,
+                            self.dropped)
+    if self.policy == "spill" and \
+       (self._spill_count or len(self.queue) >= self.limit):
+      self._spill(item)
+    else:
+      self.queue.append(item)
+    self.high_water = max(self.high_water, self._qsize())
+
+  def _get(self):
+    if self.queue:
+      return self.queue.popleft()
+    return self._unspill()
+
+  def _spill(self, item):
+    """
+    append an item to the spill file
+    """
+    if self._spill_file is None:
+      self._spill_file = tempfile.TemporaryFile(dir=self.spill_dir,
+                                                prefix=self.name+"-")
+      self.logger.warning("_spill: %s full; spilling to disk", self.name)
+    self._spill_file.seek(self._write_pos)
+    pickle.dump(item, self._spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+    self._write_pos = self._spill_file.tell()
+    self._spill_count += 1
+    self.spilled += 1
+
+  def _unspill(self):
+    """
+    read the oldest item from the spill file
+    """
+    self._spill_file.seek(self._read_pos)
+    try:
+      item = pickle.load(self._spill_file)
+    except Exception:
+      # the rest of the file cannot be read either
+      self.logger.error("_unspill: %s spill file unreadable; %d items dropped",
+                        self.name, self._spill_count)
+      self._discard_spill()
+      raise
+    self._read_pos = self._spill_file.tell()
+    self._spill_count -= 1
+    if not self._spill_count:
+      # start the file again
+      self._spill_file.truncate(0)
+      self._read_pos = self._write_pos = 0
+    return item
+
+  def _discard_spill(self):
+    """
+    drop the items in the spill file
+    """
+    self.dropped += self._spill_count
+    self.unfinished_tasks -= self._spill_count
+    self._spill_count = 0
+    self._spill_file.truncate(0)
+    self._read_pos = self._write_pos = 0
+
+  def metrics(self):
+    """
+    the state and history of the queue
+
+    @return: dict with 'name', 'policy', 'limit', 'depth' (items held),
+             'spilled_now' (items on disk), 'high_water', 'puts', 'dropped'
+             and 'spilled' (items ever written to disk)
+    """
+    with self.mutex:
+      return {"name": self.name, "policy": self.policy, "limit": self.limit,
+              "depth": self._qsize(), "spilled_now": self._spill_count,
+              "high_water": self.high_water, "puts": self.puts,
+              "dropped": self.dropped, "spilled": self.spilled}
+
+  def close(self):
+    """
+    discard the spill file and the items in it
+    """
+    with self.mutex:
+      if self._spill_file:
+        self._discard_spill()
+        self._spill_file.close()
+        self._spill_file = None
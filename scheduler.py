@@ -0,0 +1,275 @@
+"""
+Shared acquisition scheduling for many ROACHs
+
+Normally each ``SAOfwif`` is a ``DeviceReadThread`` which calls its own
+``action()`` in a loop.  For load testing with many simulated boards that
+means many threads.  An ``AcquisitionScheduler`` instead keeps one queue of
+deadlines for all the boards and a small pool of worker threads calls the
+``action()`` of whichever board is due next.
+
+A reader driven by the scheduler must provide::
+
+  action()   - acquire one record; called when the deadline has been reached
+  deadline() - when ``action()`` is next due, or None when there is no more to
+               do until the reader is scheduled again
+
+``AsyncAcquisition`` does the same with an asyncio event loop.  Each reader is
+a task which sleeps until its deadline and puts the reader's record on a
+bounded ``asyncio.Queue``, from which one consumer task feeds the combiner.
+Such a reader provides ``next_record()`` instead of ``action()``.  The
+combiner is called from a single worker thread, so that nothing it waits for
+blocks the event loop.
+"""
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+def nowgmt():
+  return time.time()+ time.altzone
+
+class AcquisitionScheduler(object):
+  """
+  Calls the ``action()`` of many readers from one deadline queue
+
+  A reader is never run by two workers at once, so each board's records stay
+  in order.
+
+  Attributes::
+    logger   - logging.Logger instance
+    queue    - heap of (deadline, sequence number, reader)
+    running  - readers whose ``action()`` is being executed
+    threads  - worker threads
+  """
+  def __init__(self, workers=1, name="scheduler"):
+    """
+    start the worker threads
+
+    @param workers : number of worker threads
+    @type  workers : int
+    """
+    self.logger = logging.getLogger(logger.name+".AcquisitionScheduler")
+    self.queue = []
+    self.running = set()
+    self.condition = threading.Condition()
+    self.sequence = itertools.count()
+    self.threads = []
+    for num in range(workers):
+      thread = threading.Thread(target=self.run, name="%s-%d" % (name, num))
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+    self.logger.debug("__init__: %d workers started", workers)
+
+  def schedule(self, reader, when=None):
+    """
+    have ``reader.action()`` called at ``when``; default: now
+
+    Any earlier entry for the reader is replaced.
+    """
+    if when is None:
+      when = nowgmt()
+    with self.condition:
+      self._remove(reader)
+      heapq.heappush(self.queue, (when, next(self.sequence), reader))
+      self.condition.notify()
+
+  def cancel(self, reader):
+    """
+    remove a reader from the queue
+    """
+    with self.condition:
+      self._remove(reader)
+
+  def _remove(self, reader):
+    """
+    remove a reader's entries; the condition must be held
+    """
+    entries = [entry for entry in self.queue if entry[2] is not reader]
+    if len(entries) != len(self.queue):
+      self.queue = entries
+      heapq.heapify(self.queue)
+
+  def next_reader(self):
+    """
+    wait for the earliest deadline and claim its reader
+    """
+    with self.condition:
+      while True:
+        if not self.queue:
+          self.condition.wait()
+          continue
+        delay = self.queue[0][0] - nowgmt()
+        if delay > 0:
+          self.condition.wait(delay)
+          continue
+        when, count, reader = heapq.heappop(self.queue)
+        if reader in self.running:
+          # its worker will reschedule it when done
+          continue
+        self.running.add(reader)
+        return reader
+
+  def run(self):
+    """
+    worker loop
+    """
+    while True:
+      reader = self.next_reader()
+      try:
+        reader.action()
+        when = reader.deadline()
+      except Exception:
+        self.logger.error("run: %s failed", reader, exc_info=True)
+        when = None
+      with self.condition:
+        self.running.discard(reader)
+      if when is not None:
+        self.schedule(reader, when)
+
+class AsyncAcquisition(object):
+  """
+  Runs readers as tasks on an asyncio event loop in its own thread
+
+  Cancelling a reader's task stops its scan at once, even in the middle of an
+  integration.
+
+  The queue holds at most ``queue_size`` records.  When it is full, a reader
+  waits for room with the "block" policy, without holding up the loop, or the
+  oldest record is discarded with "drop-oldest".  "spill" is not available
+  here.  ``metrics()`` reports on the queue as ``queues.BoundedQueue`` does.
+
+  Attributes::
+    consumer - function called with each record, e.g. ``combine_data``
+    executor - the thread from which ``consumer`` is called
+    logger   - logging.Logger instance
+    loop     - the event loop
+    policy   - "block" or "drop-oldest"
+    queue    - asyncio.Queue of records from all the readers
+    tasks    - acquisition task for each reader
+    timer    - timing.StageTimer marking 'queued', if given
+  """
+  def __init__(self, consumer, name="acquisition", timer=None, queue_size=64,
+                     queue_policy="block"):
+    """
+    start the event loop
+
+    @param consumer : function which takes one record
+
+    @param queue_size : most records waiting for the consumer
+    @type  queue_size : int
+
+    @param queue_policy : "block" or "drop-oldest" when the queue is full
+    @type  queue_policy : str
+    """
+    if queue_policy not in ("block", "drop-oldest"):
+      raise ValueError("asyncio acquisition cannot use queue policy %s"
+                       % queue_policy)
+    self.logger = logging.getLogger(logger.name+".AsyncAcquisition")
+    self.consumer = consumer
+    self.timer = timer
+    self.name = name
+    self.queue_size = queue_size
+    self.policy = queue_policy
+    self.puts = 0
+    self.high_water = 0
+    self.dropped = 0
+    self.tasks = {}
+    self.queue = None
+    self.executor = concurrent.futures.ThreadPoolExecutor(
+                                      max_workers=1, thread_name_prefix="combine")
+    self.loop = asyncio.new_event_loop()
+    self.thread = threading.Thread(target=self.run, name=name)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def run(self):
+    """
+    thread target; runs the event loop
+    """
+    asyncio.set_event_loop(self.loop)
+    self.queue = asyncio.Queue(maxsize=self.queue_size)
+    self.loop.create_task(self.combine())
+    self.loop.run_forever()
+
+  def schedule(self, reader, when=None):
+    """
+    start (or restart) acquisition for a reader
+
+    ``when`` is accepted for compatibility with ``AcquisitionScheduler``; the
+    reader's own ``deadline()`` is used.
+    """
+    self.loop.call_soon_threadsafe(self._start, reader)
+
+  def cancel(self, reader):
+    """
+    stop acquisition for a reader
+    """
+    self.loop.call_soon_threadsafe(self._cancel, reader)
+
+  def _start(self, reader):
+    self._cancel(reader)
+    self.tasks[reader] = self.loop.create_task(self.acquire(reader))
+
+  def _cancel(self, reader):
+    task = self.tasks.pop(reader, None)
+    if task:
+      task.cancel()
+
+  async def acquire(self, reader):
+    """
+    wait for each deadline and queue the reader's record
+    """
+    when = reader.deadline()
+    while when is not None:
+      delay = when - nowgmt()
+      if delay > 0:
+        await asyncio.sleep(delay)
+      msg = reader.next_record()
+      if msg is not None:
+        await self.put(msg)
+        if self.timer and msg["type"] == "spectrum":
+          self.timer.mark("queued", msg["name"], msg["scan"], msg["record"])
+      when = reader.deadline()
+    # finished normally, not cancelled and replaced
+    del self.tasks[reader]
+
+  async def put(self, msg):
+    """
+    queue a record according to the policy
+    """
+    if self.policy == "drop-oldest" and self.queue.full():
+      self.queue.get_nowait()
+      self.dropped += 1
+      if self.dropped == 1 or self.dropped % 100 == 0:
+        self.logger.warning("put: %s full; %d records dropped", self.name,
+                            self.dropped)
+    await self.queue.put(msg)
+    self.puts += 1
+    self.high_water = max(self.high_water, self.queue.qsize())
+
+  def metrics(self):
+    """
+    the state and history of the queue, like ``BoundedQueue.metrics()``
+    """
+    return {"name": self.name, "policy": self.policy, "limit": self.queue_size,
+            "depth": self.queue.qsize() if self.queue else 0,
+            "spilled_now": 0, "high_water": self.high_water,
+            "puts": self.puts, "dropped": self.dropped, "spilled": 0}
+
+  async def combine(self):
+    """
+    pass records to the consumer, in order, from the executor thread
+    """
+    while True:
+      msg = await self.queue.get()
+      try:
+        await self.loop.run_in_executor(self.executor, self.consumer, msg)
+      except Exception:
+        self.logger.error("combine: failed for %s", msg.get("name"),
+                          exc_info=True)
@@ -63,14 +63,16 @@ think of ``action()`` as an ``SAOfwif`` method provided by the parent
 
 *Metadata*
 
-The SAOfwif object creates an HDF5 file when it is initialised. The firmware
+If ``write_to_disk`` is set, the SAOfwif object creates an HDF5 file when it is
+initialised; it is written by a ``datafile.RecordWriter`` thread. The firmware
 register data which do not change are attrs of the top level of the HDF5
 hierarchy. The SAObackend method ``start(N)`` will start a new scan of N records
 for each ROACH. Scans are at the second level of the HDF5 hierarchy. The attrs
 of the scan level of the file are those firmware registers which do not change
 during a scan. Each record is written to disk as it is acquired. The attrs of
 the record level are the register values which change all the time, and also
-time in seconds.
+time in seconds. A new file is started when ``max_data_file_size`` bytes of
+data have been written.
 
 Example
 =======
@@ -90,15 +92,23 @@ import math
 import numpy
 import os.path
 import Pyro5
-import scipy.stats as stats
 import socket
+import tempfile
+import threading
 import time
 
 import MonitorControl as MC
 import MonitorControl.BackEnds as BE
 import MonitorControl.BackEnds.ROACH1 as ROACH1
 import MonitorControl.BackEnds.ROACH1.combiner as combiner
+import MonitorControl.BackEnds.ROACH1.datafile as datafile
+import MonitorControl.BackEnds.ROACH1.display as display
 import MonitorControl.BackEnds.ROACH1.firmware_server as fws
+import MonitorControl.BackEnds.ROACH1.hotlog as hotlog
+import MonitorControl.BackEnds.ROACH1.queues as queues
+import MonitorControl.BackEnds.ROACH1.scheduler as scheduler
+import MonitorControl.BackEnds.ROACH1.timing as timing
+import MonitorControl.BackEnds.ROACH1.wireformat as wireformat
 import Radio_Astronomy as RA
 import support
 import support.local_dirs
@@ -112,6 +122,12 @@ modulepath = os.path.dirname(os.path.abspath(__file__))
 paramfile = "model_params.xlsx"
 max_spectra_per_scan = 120 # 1 h at 5 s per spectrum
 T_sys = 60
+ADC_scale = 107/math.sqrt(math.pi) # ADC sample std for 0 dBm into the chip
+ADC_snap_size = 2048
+data_dir = "/home/ops/roach_data/sao_test_data/"
+if not os.path.exists(data_dir):
+  # not in the package source directory
+  data_dir = tempfile.gettempdir()
 
 def nowgmt():
   return time.time()+ time.altzone
@@ -119,6 +135,81 @@ def nowgmt():
 def logtime():
   return datetime.datetime.utcnow().strftime("%H:%M:%S.%f")[:-3]
 
+def ADC_sample_scale(rf_gain=0.):
+  """
+  Simulated ADC sample std for a KATADC RF gain, for a 0 dBm input at 0 dB gain
+
+  @param rf_gain : RF section gain in dB; may be an array
+  @type  rf_gain : float
+  """
+  return ADC_scale*10**(numpy.asarray(rf_gain, dtype=float)/20)
+
+def simulate_ADC_snaps(rng, shape=(), scale=ADC_scale):
+  """
+  Simulate ADC snap blocks
+
+  The samples are clipped to the int8 range, as a real ADC saturates.
+
+  @param rng : random number generator
+  @type  rng : numpy.random.Generator
+
+  @param shape : shape of the block of snaps, e.g. (roaches, records)
+  @type  shape : tuple of int
+
+  @param scale : sample std; an array must broadcast against ``shape``
+  @type  scale : float
+
+  @return: int8 array of shape ``shape + (ADC_snap_size,)``
+  """
+  scale = numpy.expand_dims(numpy.asarray(scale, dtype=float), -1)
+  data = rng.standard_normal(size=tuple(shape)+(ADC_snap_size,))*scale
+  return numpy.clip(data, -128, 127).astype(numpy.int8)
+
+def ADC_levels(samples):
+  """
+  Signal levels into the ADC for a block of snaps
+
+  This computes, along the last axis, what ``Channel.get_ADC_input()`` does
+  for one snap, and the fraction of samples which are clipped.
+
+  @param samples : ADC samples, e.g. (inputs x samples)
+  @type  samples : int8 array
+
+  @return: dict of arrays with the shape of ``samples`` less its last axis
+  """
+  level = {}
+  # fraction of samples at the ends of the int8 range
+  level["clipped"] = ((samples <= -128) | (samples >= 127)).mean(axis=-1)
+  samples = numpy.asarray(samples, dtype=float)
+  level["sample mean"] = samples.mean(axis=-1)
+  level["sample std"] = samples.std(axis=-1)
+  level["Vrms ADC"] = level["sample std"]*ROACH1.adc_cnt_mv_scale_factor()/1000
+  level["W ADC"] = level["Vrms ADC"]**2/50
+  with numpy.errstate(divide="ignore"):
+    level["dBm ADC"] = 10*numpy.log10(level["W ADC"]) + 30
+  return level
+
+def simulate_spectra(rng, sample_rms, n_raw, num_chan):
+  """
+  Simulate a block of accumulated spectra in one call
+
+  ``sample_rms`` holds the ADC sample RMS for each spectrum to be made, so its
+  shape is typically (records,) or (roaches, records).  ``n_raw`` is the number
+  of raw spectra per accumulation and must broadcast against ``sample_rms``.
+  Each spectrum is::
+
+    sample_rms * n_raw + normal(loc=sample_rms, scale=1)
+
+  which is what ``SAOfwif.get_spectrum()`` used to compute one record at a time.
+
+  @return: float array of shape ``sample_rms.shape + (num_chan,)``
+  """
+  sample_rms = numpy.asarray(sample_rms, dtype=float)
+  offset = sample_rms*(numpy.asarray(n_raw) + 1)
+  spectra = rng.standard_normal(size=sample_rms.shape+(num_chan,))
+  spectra += offset[..., numpy.newaxis]
+  return spectra
+
 
   
 ################################ classes #################################
@@ -126,33 +217,122 @@ def logtime():
 class RoachCombiner(combiner.DataCombiner):
   """
   subclass with meaningful ``process_data`` method
+
+  ``wire_format`` selects how records are sent to the client: "lists" (the
+  default) or packed binary "float32" or "float64" (see ``wireformat``).
+
+  If ``writer`` is a ``datafile.CombinedWriter`` each combined record is also
+  written to its file.  Late spectra patched in (``late_policy="patch"``) are
+  written there too and sent to the client as lists.
+
+  Records are serialized on the combiner thread and put on ``outqueue``, a
+  ``queues.BoundedQueue`` from which a delivery thread makes the client
+  callbacks, so a slow client does not hold up combining.  By default the
+  oldest undelivered records are dropped when it is full.
   """
-  def __init__(self, parent=None, dsplist=None):
-    """
-    initialize a DataCombiner
-    """
-    combiner.DataCombiner.__init__(self, dsplist=dsplist)
+  def __init__(self, parent=None, dsplist=None, timer=None,
+                     max_record_age=None, late_policy="drop",
+                     queue_size=64, queue_policy="block", delivery_size=32,
+                     delivery_policy="drop-oldest", spill_dir=None):
+    """
+    initialize a DataCombiner and start the delivery thread
+    """
+    combiner.DataCombiner.__init__(self, dsplist=dsplist, timer=timer,
+                                   max_record_age=max_record_age,
+                                   late_policy=late_policy,
+                                   queue_size=queue_size,
+                                   queue_policy=queue_policy,
+                                   spill_dir=spill_dir)
     self.parent = parent
     self.logger = logging.getLogger(logger.name+".RoachCombiner")
     self.callback = None
+    self.wire_format = "lists"
+    self.writer = None
+    self.outqueue = queues.BoundedQueue(delivery_size, policy=delivery_policy,
+                                        spill_dir=spill_dir, name="delivery")
+    self.delivery = threading.Thread(target=self.deliver, name="delivery")
+    self.delivery.daemon = True
+    self.delivery.start()
+
+  def serialize(self, msg):
+    """
+    convert a combined record to what is sent to the client
+    """
+    dtype = wireformat.wire_formats[self.wire_format]
+    if dtype:
+      return wireformat.pack_record(msg, dtype=dtype)
+    else:
+      return combiner.serializable(msg)
   
   def process_data(self, msg):
     """
     replaces method in superclass
     """
     self.logger.debug("process_data: got %s items", len(msg))
+    if self.timer:
+      self.timer.mark("emitted", None, msg["scan"], msg["record"])
+    try:
+      self.parent.display.update(msg)
+    except Exception:
+      # the display must never stop the combining
+      self.logger.error("process_data: display update failed for scan %s"
+                        " record %s", msg["scan"], msg["record"], exc_info=True)
+    if self.writer:
+      self.writer.put(msg)
     self.logger.debug("process_data: callback is %s", self.parent.start.cb)
     self.callback = self.parent.start.cb
-    self.caller = self.parent.start.caller
     if self.callback:
-      self.logger.debug("process_data: callback is %s", self.callback)
-      # claim method from another thread
-      self.caller._pyroClaimOwnership()
-      # invoke callback's method
-      #self.callback.finished(msg)
-      self.callback(msg)
+      # Pyro needs lists or bytes, not arrays; this also copies the spectra
+      # out of the combiner's buffer
+      self.outqueue.put((self.serialize(msg), msg["scan"], msg["record"]))
     else:
       self.logger.error("process_data: no callback specified") 
+
+  def begin_scan(self, scan):
+    """
+    extends method in superclass; starts a new scan in the combined file
+    """
+    combiner.DataCombiner.begin_scan(self, scan)
+    if self.writer:
+      self.writer.begin_scan(scan)
+
+  def process_patch(self, patch):
+    """
+    replaces method in superclass
+    """
+    if self.writer:
+      self.writer.put(patch)
+    self.callback = self.parent.start.cb
+    if self.callback:
+      # the binary wire format has no room for the record type
+      self.outqueue.put((combiner.serializable(patch), None, None))
+
+  def deliver(self):
+    """
+    delivery thread; makes the client callbacks
+
+    The queue holds only the records, which may be spilled to disk; the
+    callback is the one current when the record is delivered.
+    """
+    while True:
+      try:
+        payload, scan, record = self.outqueue.get()
+      except Exception:
+        self.logger.error("deliver: could not get a record", exc_info=True)
+        continue
+      try:
+        callback = self.parent.start.cb
+        caller = self.parent.start.caller
+        # claim method from another thread
+        caller._pyroClaimOwnership()
+        callback(payload)
+        if self.timer and scan is not None:
+          self.timer.mark("delivered", None, scan, record)
+      except Exception:
+        self.logger.error("deliver: callback failed for scan %s record %s",
+                          scan, record, exc_info=True)
+      finally:
+        self.outqueue.task_done()
     
 @Pyro5.server.expose
 class SAObackend(support.PropertiedClass):
@@ -164,23 +344,55 @@ class SAObackend(support.PropertiedClass):
 
   Attributes::
 
+    acquisition  - how the ROACHs are driven; see below
+    data_dir     - directory for data and trace files
+    display      - SpectrumDisplay with the latest spectra for web clients
     logger       - logging.Logger instance
     name         - name for the backend
     reader       - dict of DeviceReadThread objects keyed to roach names
     roach        - dict of SAOfwif objects keyed to their names
+    scheduler    - AcquisitionScheduler or AsyncAcquisition, if used
+    timer        - timing.StageTimer for the pipeline latencies
 
   The backend manages the scans for the child ROACH objects.  Their scan
   numbers are updated when the required number of records have been recorded.
 
+  With ``acquisition="threads"`` (the default) each ROACH reads in its own
+  thread.  With "shared", one ``scheduler.AcquisitionScheduler`` with a few
+  worker threads drives all the ROACHs, which allows many more simulated
+  boards per host.  With "asyncio", each ROACH is a task on one event loop
+  (``scheduler.AsyncAcquisition``) which feeds the combiner through an
+  ``asyncio.Queue``.  In every mode ``stop_scan()`` stops the scan.
+
+  ``query()`` runs several of the read-only methods in ``query_methods`` in
+  one call, so a monitor loop needs one round trip per update.  Pipeline
+  latencies are available from ``latency_stats()`` and ``latency_histogram()``
+  (see ``timing``) and queue depths from ``queue_metrics()``.  ``status()``
+  returns the state of all the ROACHs at once from values which are re-read
+  at most every ``status_interval`` seconds.
+
   Typically, the SAO client is an attribute of the main client so that the
   server's methods are called with::
   
     client.spectrometer.hardware.method()
   """
+  query_methods = ("get_current_scans", "get_current_accums", "rf_gain_get",
+                   "rf_state", "check_temperatures", "check_fans", "get_clk",
+                   "get_adc_temp", "get_ambient_temp", "get_firmware",
+                   "get_bandwidth", "read_register", "clock_synth_status",
+                   "status", "get_ADC_levels", "latency_stats",
+                   "latency_histogram", "queue_metrics")
+
   def __init__(self, name, roaches={},
                      roachlist=['roach1', 'roach2', 'roach3', 'roach4'], 
                      template='roach',
-                     synth=None, write_to_disk=False, TAMS_logging=False):
+                     synth=None, write_to_disk=False, TAMS_logging=False,
+                     acquisition="threads", workers=1, combined_file=None,
+                     compression=None, status_interval=10.0,
+                     max_record_age=None, late_policy="drop",
+                     queue_size=64, queue_policy="block", delivery_size=32,
+                     delivery_policy="drop-oldest", spill_dir=None,
+                     data_dir=data_dir):
     """
     Initialise a multi-IF high-res spectrometer.
 
@@ -202,12 +414,64 @@ class SAObackend(support.PropertiedClass):
     @type  template : str
 
     @param synth : a synthesizer object
+
+    @param write_to_disk : each ROACH writes its records to HDF5 files
+    @type  write_to_disk : bool
+
+    @param acquisition : "threads", "shared" or "asyncio"
+    @type  acquisition : str
+
+    @param workers : number of scheduler threads for "shared" acquisition
+    @type  workers : int
+
+    @param combined_file : HDF5 file for the combined records of all ROACHs
+    @type  combined_file : str
+
+    @param compression : h5py compression filter for ``combined_file``
+    @type  compression : str
+
+    @param status_interval : seconds for which ``status()`` values are kept
+    @type  status_interval : float
+
+    @param max_record_age : seconds after which the combiner emits a record
+                            without the ROACHs which have not reported
+    @type  max_record_age : float
+
+    @param late_policy : "drop" or "patch" spectra which arrive after that
+    @type  late_policy : str
+
+    @param queue_size : most ROACH records waiting for the combiner
+    @type  queue_size : int
+
+    @param queue_policy : "block", "drop-oldest" or "spill" when it is full;
+                          "spill" is not available with "asyncio"
+    @type  queue_policy : str
+
+    @param delivery_size : most combined records waiting for the client
+    @type  delivery_size : int
+
+    @param delivery_policy : "block", "drop-oldest" or "spill" when it is full
+    @type  delivery_policy : str
+
+    @param spill_dir : directory for "spill" queues; default: system temp
+    @type  spill_dir : str
+
+    @param data_dir : directory for data and trace files; default: the
+                      module's ``data_dir``
+    @type  data_dir : str
     """
     mylogger = logging.getLogger(logger.name + ".SAObackend")
     support.PropertiedClass.__init__(self)
     self.name = name # this may be a problem with Pyro
     self.logger = mylogger
     self._template = template
+    self.data_dir = data_dir
+    # random numbers for simulating all the ROACHs at once
+    self.rng = numpy.random.default_rng()
+    # cached values for status()
+    self.status_interval = status_interval
+    self._status = None
+    self._status_lock = threading.Lock()
     # firmware details
     firmware_server = fws.FirmwareServer(modulepath, paramfile)
     # ROACH firmware interface objects
@@ -224,7 +488,31 @@ class SAObackend(support.PropertiedClass):
     self.spectrum = {}
     # a combiner collects records from all the ROACH for client callback
     self.callback = None
-    self.combiner = RoachCombiner(parent=self, dsplist=self._roachkeys)
+    # timestamps of records passing through the pipeline
+    self.timer = timing.StageTimer()
+    self.combiner = RoachCombiner(parent=self, dsplist=self._roachkeys,
+                                  timer=self.timer,
+                                  max_record_age=max_record_age,
+                                  late_policy=late_policy,
+                                  queue_size=queue_size,
+                                  queue_policy=queue_policy,
+                                  delivery_size=delivery_size,
+                                  delivery_policy=delivery_policy,
+                                  spill_dir=spill_dir)
+    # how the ROACHs are driven
+    self.acquisition = acquisition
+    if acquisition == "threads":
+      self.scheduler = None
+    elif acquisition == "shared":
+      self.scheduler = scheduler.AcquisitionScheduler(workers=workers)
+    elif acquisition == "asyncio":
+      # records reach the combiner through the loop's queue, not inqueue
+      self.scheduler = scheduler.AsyncAcquisition(self.combiner.combine_data,
+                                                  timer=self.timer,
+                                                  queue_size=queue_size,
+                                                  queue_policy=queue_policy)
+    else:
+      raise ValueError("unknown acquisition mode %s" % acquisition)
     for name in self._roachkeys:
       # arguments to pass when initializing a SAOfwif object
       init = dict(parent=self,
@@ -234,7 +522,10 @@ class SAObackend(support.PropertiedClass):
                   firmware_key='sao_spec',
                   roach_log_level=logging.INFO,
                   clock_synth=synth,
-                  TAMS_logging=TAMS_logging)
+                  TAMS_logging=TAMS_logging,
+                  write_to_disk=write_to_disk,
+                  data_dir=data_dir,
+                  scheduler=self.scheduler)
       # initialize each ROACH
       self.roach[name] = SAOfwif(**init)
       self.roach[name].scan = 0
@@ -249,6 +540,14 @@ class SAObackend(support.PropertiedClass):
     self._firmware = self.get_firmware(roach)
     self._bandwidth = self.get_bandwidth(roach)
     self._bitstream = self.roach[roach].bitstream
+    # latest spectra for web clients, updated by the combiner
+    self.display = display.SpectrumDisplay(self.roachnames, self._bandwidth,
+                                           self.roach[roach].num_chan)
+    if combined_file:
+      self.combiner.writer = datafile.CombinedWriter(combined_file,
+                                                     self.roachnames,
+                                                     self.roach[roach].num_chan,
+                                                     compression=compression)
     self.logger.debug("__init__: completed for %s", self.name)
 
   @property
@@ -289,6 +588,11 @@ class SAObackend(support.PropertiedClass):
     """
     for roach in list(self.roach.keys()):
       self.roach[roach].quit()
+    if self.combiner.writer:
+      self.combiner.writer.close()
+    self.timer.stop_trace()
+    self.combiner.inqueue.close()
+    self.combiner.outqueue.close()
 
   def get_current_scans(self):
     """
@@ -305,31 +609,199 @@ class SAObackend(support.PropertiedClass):
       accums[name] = self.roach[name].spectrum_count
     return accums
 
+  def query(self, calls):
+    """
+    run several read-only methods in one call
+
+    Example::
+      In [5]: k.query(["get_current_scans", ["rf_gain_get", "roach1"],
+                       ["check_temperatures", "roach1"]])
+      Out[5]: [{'roach1': 1, ...}, 20.0, {...}]
+
+    @param calls : method names, or lists of a method name and its arguments
+    @type  calls : list
+
+    @return: list of results in the order of the calls
+    """
+    methods = []
+    for call in calls:
+      if isinstance(call, str):
+        call = [call]
+      if call[0] not in self.query_methods:
+        raise ValueError("%s cannot be used in a query" % call[0])
+      methods.append((getattr(self, call[0]), call[1:]))
+    return [method(*args) for method, args in methods]
+
+  def status(self, refresh=False):
+    """
+    state of all the ROACHs in one call
+
+    Each item except 'roaches', 'time' and 'age' is a list in the order of
+    'roaches'.  Scans and accumulations are current; the hardware readings
+    are re-read when they are older than ``status_interval`` seconds or
+    ``refresh`` is True.
+
+    Example::
+      In [6]: k.status()
+      Out[6]: {'roaches': ['roach1', 'roach2', 'roach3', 'roach4'],
+               'time': 1566584283.3, 'age': 2.1,
+               'scan': [3, 3, 3, 3], 'accums': [17, 17, 17, 17],
+               'rf_gain': [20.0, 20.0, 20.0, 20.0],
+               'rf_enabled': [True, True, True, True],
+               'clock': [640.0, 640.0, 640.0, 640.0],
+               'adc_temp': [70.0, 70.0, 70.0, 70.0],
+               'ambient_temp': [40.0, 40.0, 40.0, 40.0]}
+    """
+    names = self.roachnames
+    with self._status_lock:
+      if refresh or self._status is None or \
+         time.time() - self._status["time"] > self.status_interval:
+        readings = {"rf_gain": [], "rf_enabled": [], "clock": [],
+                    "adc_temp": [], "ambient_temp": []}
+        for name in names:
+          roach = self.roach[name]
+          channel = roach.RFchannel[0]
+          channel.rf_gain_get()
+          readings["rf_gain"].append(channel.rf_gain)
+          readings["rf_enabled"].append(channel.rf_enabled)
+          readings["clock"].append(roach.get_clk())
+          readings["adc_temp"].append(roach.get_adc_temp())
+          readings["ambient_temp"].append(roach.get_ambient_temp())
+          self.rf_enabled[name][0][0] = channel.rf_enabled
+        readings["time"] = time.time()
+        self._status = readings
+      status = dict(self._status)
+    status["roaches"] = names
+    status["age"] = time.time() - status["time"]
+    status["scan"] = [self.roach[name].scan for name in names]
+    status["accums"] = [self.roach[name].spectrum_count for name in names]
+    return status
+
+  def latency_stats(self, interval="total"):
+    """
+    pipeline latency statistics by ROACH
+
+    @param interval : one of ``timing.intervals``, e.g. "integration",
+                      "queue", "combining", "delivery" or "total"
+    @type  interval : str
+
+    @return: dict of count, mean, min, max, p50, p90, p99 (s) for each ROACH
+    """
+    return self.timer.stats(interval)
+
+  def latency_histogram(self, interval="total", bins=20):
+    """
+    pipeline latency histograms by ROACH
+
+    @return: dict with bin 'edges' in seconds and 'counts' for each ROACH
+    """
+    return self.timer.histogram(interval, bins=bins)
+
+  def queue_metrics(self):
+    """
+    depth, high-water mark, dropped and spilled counts of the pipeline queues
+
+    Example::
+      In [7]: k.queue_metrics()["delivery"]
+      Out[7]: {'name': 'delivery', 'policy': 'drop-oldest', 'limit': 32,
+               'depth': 0, 'spilled_now': 0, 'high_water': 3, 'puts': 120,
+               'dropped': 0, 'spilled': 0}
+    """
+    if self.acquisition == "asyncio":
+      # the queue which actually feeds the combiner
+      incoming = self.scheduler.metrics()
+    else:
+      incoming = self.combiner.inqueue.metrics()
+    return {"combiner": incoming,
+            "delivery": self.combiner.outqueue.metrics()}
+
+  def start_trace(self, filename=None):
+    """
+    append pipeline stage times to a binary trace file
+
+    Analyse the file with ``apps/trace_analysis.py``.
+
+    @param filename : default: trace_<UTC time>.bin in ``data_dir``
+    @type  filename : str
+
+    @return: name of the trace file
+    """
+    if filename is None:
+      filename = os.path.join(self.data_dir, "trace_%s.bin" %
+                   datetime.datetime.utcnow().strftime("%Y%m%d_%H%M%S"))
+    self.timer.start_trace(filename, self.roachnames)
+    return filename
+
+  def stop_trace(self):
+    """
+    close the trace file
+    """
+    self.timer.stop_trace()
+
+  def hotlog_enable(self, stage, enabled=True):
+    """
+    turn the per-record DEBUG messages of a stage on or off
+
+    The stages are "action" (SAOfwif acquisition), "combine" (the combiner)
+    and "ADC" (ADC snaps).  DEBUG messages are written only if the logger is
+    also set to DEBUG.
+
+    @return: dict with the state of each stage
+    """
+    return hotlog.enable(stage, enabled)
+
+  def hotlog_flags(self):
+    """
+    which stages write their per-record DEBUG messages
+    """
+    return dict(hotlog.flags)
+
+  def enable_timing(self, enabled=True):
+    """
+    turn the recording of pipeline stage times on or off
+    """
+    self.timer.enabled = enabled
+    return self.timer.enabled
+
   def help(self):
     """
     """
     return get_help(self.__class__)
   
   @async_method.async_method # @Pyro5.api.oneway
-  def start(self, n_accums=max_spectra_per_scan, integration_time=10.0):
+  def start(self, n_accums=max_spectra_per_scan, integration_time=10.0,
+                  wire_format="lists"):
     """
     start a scan consisting of 'n_accums' accumulations
 
     Adapted from SAObackend.start and SAObackend.action.  This decorated 
     `oneway` so its not return a result and won't hold up the calling
     thread.
+
+    @param wire_format : "lists", or "float32" or "float64" for packed records
+    @type  wire_format : str
     """
     self.logger.debug("start: called for %d accumulations", n_accums)
+    if wire_format not in wireformat.wire_formats:
+      raise ValueError("unknown wire format %s" % wire_format)
+    self.combiner.wire_format = wire_format
     #self.logger.debug("start: callback is %s", self.start.cb)
     #self.combiner.callback = self.start.cb
     self.set_integration(integration_time)
+    self.combiner.records_per_scan = n_accums
+    # all the ROACHs integrate on the same schedule
     for name in list(self.roach.keys()):
-      self.logger.debug("start: starting %s", name)
       if self.roach[name].scan == 0:
         self.roach[name].scan = 1
+    # the scan numbers may have been used before reset_scans()
+    for scan in set(self.get_current_scans().values()):
+      self.combiner.begin_scan(scan)
+    start_time = nowgmt()
+    for name in list(self.roach.keys()):
+      self.logger.debug("start: starting %s", name)
       self.roach[name].max_count = n_accums
       self.roach[name].spectrum_count = 0 # so first one is '1'
-      self.roach[name].sync_start()
+      self.roach[name].sync_start(start_time)
 
   #@Pyro5.api.oneway
   def last_spectra(self, dolog=True, squish=16):
@@ -338,53 +810,106 @@ class SAObackend(support.PropertiedClass):
 
       Returns a list of lists that is compatible with Google Charts LineChart
 
-      We cheat a little in assuming that each ROACH has the same scan and
-      spectrum numbers.
+      The table comes from ``self.display``, which is updated as each combined
+      record arrives, so a poll does not recompute it.  Before any record has
+      arrived, the ROACHs are asked for a spectrum each.
 
       Arguments:
         dolog - return log10 of data if True; negative number become 0
-        squish - number of channels to average
+        squish - number of channels to average; must divide the number of
+                 channels
       """
       self.logger.debug("last_spectra: called")
-      if squish > 1:
-        pass
-      else:
-        # may not be 0 or negative
-        squish = 16
-      names = list(self.roach.keys())
-      names.sort()
-      titles = ["Frequency"] + names
-      npts = int(self.roach[names[0]].freqs.shape[0]/squish)
-      freqs = BE.get_freq_array(self.roach[names[0]].bandwidth, npts)
-      # data have a typical spreedsheet organization, one list per line
-      # this is the first column
-      spectra = freqs.reshape(npts,1) # converts from 1D to 2D array
-      # for each ROACH, one column for each ROACH
-      for name in names:
-          self.logger.debug("last_spectra: %s", name)
-          spectrum = self.roach[name].get_spectrum()
-          self.logger.debug("last_spectra: got %d samples", len(spectrum))
-          # average over 'squish' channels
-          
-          result = spectrum.reshape(spectrum.shape[0]//squish, squish)
-          result = result.mean(axis=1)
-          self.logger.debug("last_spectra: converted to %s array",
-                             result.shape)
-          if dolog:
-            result = numpy.log10(result)
-            result[result==-numpy.inf]=0
-          column = result.reshape(npts,1)
-          self.logger.debug("last_spectra: column shape is %s", column.shape)
-          spectra = numpy.append(spectra, column, axis=1)
-      final_list = [titles] + spectra.tolist()
-      self.logger.debug("last_spectra: got %s", final_list[0:5])
-      return {"scan":   self.roach[names[0]].scan,
-              "record": self.roach[names[0]].spectrum_count,
-              "table":  final_list}
+      # a bad value is refused before anything is computed
+      self.display.check_squish(squish)
+      self._prime_display()
+      result = self.display.get(squish=squish, dolog=dolog)
+      self.logger.debug("last_spectra: got %s", result["table"][0:5])
+      return result
+
+  def spectrum_window(self, fmin=0, fmax=None, width=800, dolog=True):
+      """
+      Get a frequency range of the current spectra at a given resolution
+
+      This is for zooming in on the spectra.  The data come from the
+      multi-resolution pyramid in ``self.display`` so that only about
+      ``width`` points are computed and sent.
+
+      Arguments:
+        fmin  - lowest frequency in MHz
+        fmax  - highest frequency in MHz; default: the bandwidth
+        width - number of points wanted, e.g. plot width in pixels
+        dolog - return log10 of data if True; negative number become 0
+      """
+      if fmax is None:
+        fmax = self.bandwidth
+      self._prime_display()
+      return self.display.window(fmin, fmax, width, dolog=dolog)
+
+  def _prime_display(self):
+      """
+      Give the display a spectrum from each ROACH if no record has arrived
+      """
+      if self.display.latest is None:
+        first = self.roach[self.roachnames[0]]
+        self.display.update({"scan":   first.scan,
+                             "record": first.spectrum_count,
+                             "data":   {name: self.roach[name].get_spectrum()
+                                        for name in self.roachnames}})
 
   def reset_scans(self):
     for name in self.roach:
       self.roach[name].scan = 0
+    self.combiner.reset()
+
+  def stop_scan(self):
+    """
+    Stop the scan in progress on all the ROACHs
+
+    Records still being integrated are abandoned.  The next ``start()`` begins
+    a new scan.
+    """
+    for name in self.roachnames:
+      self.roach[name].stop_acquiring()
+
+  def get_spectra(self, n_records=max_spectra_per_scan):
+    """
+    Simulate ``n_records`` spectra for every ROACH in one vectorized call
+
+    All the ROACHs are assumed to have the same number of channels.  The ADC
+    snaps which set the level of each spectrum are also made in one call, at
+    each ROACH's RF gain.
+
+    @param n_records : number of records per ROACH
+    @type  n_records : int
+
+    @return: (roaches x records x channels) array in ``roachnames`` order
+    """
+    names = self.roachnames
+    num_chan = self.roach[names[0]].num_chan
+    n_raw = numpy.array([self.roach[name].n_raw for name in names])
+    gains = [self.roach[name].RFchannel[0].rf_gain for name in names]
+    scale = ADC_sample_scale(gains)[:, numpy.newaxis]
+    sample_rms = simulate_ADC_snaps(self.rng, (len(names), n_records),
+                                    scale=scale).std(axis=-1)
+    return simulate_spectra(self.rng, sample_rms, n_raw[:, numpy.newaxis],
+                            num_chan)
+
+  def preload_spectra(self, n_records=max_spectra_per_scan):
+    """
+    Make the next ``n_records`` spectra of every ROACH in one call
+
+    Each ROACH's ``get_spectrum()`` then serves records from this block.  This
+    is meant for regression runs which go faster than real time.
+
+    The spectra depend on the integration time.  Call this after
+    ``set_integration()`` and then ``start()`` with the same
+    ``integration_time``; a different integration time, or a change of RF
+    gain, discards the block.
+    """
+    block = self.get_spectra(n_records)
+    for index, name in enumerate(self.roachnames):
+      self.roach[name].load_spectra(block[index])
 
     
   # The following methods invoke individual ROACH methods.  This is to make
@@ -498,6 +1023,122 @@ class SAObackend(support.PropertiedClass):
                       self.roach[roachname].RFchannel[RF])
     return self.roach[roachname].RFchannel[RF].get_ADC_input()
 
+  def get_ADC_levels(self):
+    """
+    signal levels into all the ADC inputs of all the ROACHs in one call
+
+    All the inputs are snapped into one (inputs x samples) int8 array and the
+    levels are computed together.  Each item is a list with one value per
+    input, in the order of 'roaches' and 'RF'.
+
+    Example::
+      In [22]: k.get_ADC_levels()["dBm ADC"]
+      Out[22]: [0.48, 0.51, 0.47, 0.50]
+    """
+    inputs = [(name, RF) for name in self.roachnames
+                         for RF in sorted(self.roach[name].RFchannel)]
+    gains = [self.roach[name].RFchannel[RF].rf_gain for name, RF in inputs]
+    samples = simulate_ADC_snaps(self.rng, (len(inputs),),
+                                 scale=ADC_sample_scale(gains))
+    levels = {key: value.tolist()
+              for key, value in ADC_levels(samples).items()}
+    levels["roaches"] = [name for name, RF in inputs]
+    levels["RF"] = [RF for name, RF in inputs]
+    levels["rf_gain"] = gains
+    self.logger.debug("get_ADC_levels: %s dBm", levels["dBm ADC"])
+    return levels
+
+  def auto_level(self, target=None, tolerance=0.5, max_iterations=2,
+                       clip_limit=0.01, clip_step=10.):
+    """
+    set the RF gains of all the inputs to give the target level into the ADCs
+
+    For each input the gain needed is the present gain plus the difference
+    between the target and the measured level.  The attenuator setting whose
+    calibrated gain (``ROACH1.atten_gain_map``) is nearest is chosen for all
+    the inputs at once.
+
+    A saturated ADC reads low, so that step would overshoot.  An input with
+    more than ``clip_limit`` of its samples clipped and a level above the
+    target is first stepped down by ``clip_step`` dB until it is not.  These
+    steps are not counted in ``max_iterations``.
+
+    An input which cannot reach the target within the gain range, or only
+    with the ADC saturated, is flagged in 'out_of_range' and logged.
+
+    Example::
+      In [23]: k.auto_level(-5)
+      Out[23]: {'iterations': 1, 'target': -5, 'rf_gain': [-5.0, ...],
+                'dBm ADC': [-5.03, ...], 'out_of_range': [False, ...],
+                'roaches': [...], 'RF': [...]}
+
+    @param target : level into the ADC in dBm; default: the firmware's
+                    desired_rf_level
+    @type  target : float
+
+    @param tolerance : dB within which a level is good enough
+    @type  tolerance : float
+
+    @param max_iterations : most times to set the gains from the levels
+    @type  max_iterations : int
+
+    @param clip_limit : fraction of clipped samples which means saturation
+    @type  clip_limit : float
+
+    @param clip_step : dB by which the gain of a saturated input is reduced
+    @type  clip_step : float
+
+    @return: dict like ``get_ADC_levels()`` with 'target', 'iterations',
+             'clip_steps' and 'out_of_range'
+    """
+    if target is None:
+      target = self.roach[self.roachnames[0]].summary["desired_rf_level"]
+    gain_map = ROACH1.atten_gain_map['katadc']
+    settings = numpy.array(sorted(gain_map))
+    calibrated = numpy.array([gain_map[setting] for setting in settings])
+    levels = self.get_ADC_levels()
+    iterations = 0
+    clip_steps = 0
+    while iterations < max_iterations:
+      measured = numpy.array(levels["dBm ADC"])
+      gains = numpy.array(levels["rf_gain"])
+      saturated = (numpy.array(levels["clipped"]) > clip_limit) & \
+                  (measured > target) & (gains > calibrated.min())
+      if saturated.any():
+        needed = numpy.where(saturated, gains - clip_step, gains)
+        clip_steps += 1
+      else:
+        error = target - measured
+        if numpy.all(numpy.abs(error) <= tolerance):
+          break
+        needed = gains + error
+        iterations += 1
+      choice = numpy.abs(calibrated[None, :] - needed[:, None]).argmin(axis=1)
+      for name, RF, gain in zip(levels["roaches"], levels["RF"],
+                                settings[choice]):
+        self.roach[name].RFchannel[RF].rf_gain_set(gain=float(gain))
+      levels = self.get_ADC_levels()
+    measured = numpy.array(levels["dBm ADC"])
+    gains = numpy.array(levels["rf_gain"])
+    too_high = (measured > target + tolerance) & (gains <= calibrated.min())
+    too_low = (measured < target - tolerance) & (gains >= calibrated.max())
+    # a saturated level is not a true one
+    saturated = numpy.array(levels["clipped"]) > clip_limit
+    out_of_range = too_high | too_low | saturated
+    for index in numpy.flatnonzero(out_of_range):
+      self.logger.warning("auto_level: %s RF%d is at %.1f dBm with %.1f dB"
+                          " gain and %.1f%% clipped; %s dBm is out of range",
+                          levels["roaches"][index], levels["RF"][index],
+                          measured[index], gains[index],
+                          100*levels["clipped"][index], target)
+    self.logger.info("auto_level: %s dBm after %d iterations: %s", target,
+                     iterations, levels["dBm ADC"])
+    levels["target"] = target
+    levels["iterations"] = iterations
+    levels["clip_steps"] = clip_steps
+    levels["out_of_range"] = out_of_range.tolist()
+    return levels
+
   # methods for firmware
 
   @ROACH1.roach_name_adaptor
@@ -682,6 +1323,7 @@ class SAOfwif(MC.DeviceReadThread):
        Send a command to the ROACH PPC."""
 
   max_data_file_size = 1e9
+  spectrum_batch_size = 16
   file_attr_keys = ['sys_board_id', 'sys_rev', 'sys_rev_rcs']
   scan_attr_keys = ['control', 'fft_shift', 'adc_ctrl0', 'acc_len']
   accum_reg_keys = ['status', 'sync_start', 'sys_scratchpad', 'acc_cnt',
@@ -698,7 +1340,9 @@ class SAOfwif(MC.DeviceReadThread):
                      integr_time        = 1,
                      write_to_disk   = False,
                      TAMS_logging    = False,
-                     timing_report   = False):
+                     timing_report   = False,
+                     data_dir        = data_dir,
+                     scheduler       = None):
     mylogger = logging.getLogger(logger.name + ".SAOfwif")
     mylogger.debug("__init__: initializing %s", roach)
     # the first argument (after 'self') is the object providing 'action'
@@ -713,8 +1357,28 @@ class SAOfwif(MC.DeviceReadThread):
     else:
       raise RuntimeError("a firmware server is required")
     self.logger = mylogger
+    self.hotlog = hotlog.HotLogger(mylogger, "action")
     self.get_params()
     self.freqs = BE.get_freq_array(self.bandwidth, self.num_chan)
+    # simulated spectra are made in blocks and served one record at a time
+    self.rng = numpy.random.default_rng()
+    self._spectra = None
+    self._next_spectrum = 0
+    self.n_raw = None
+    # set to cut short the wait for the end of an integration
+    self.wakeup = threading.Event()
+    # when there is a scheduler it calls ``action()`` instead of the thread
+    self.scheduler = scheduler
+    self.acquiring = False
+    # records are written by a background thread
+    if write_to_disk:
+      timestamp = datetime.datetime.utcnow().strftime("%Y-%j-%Hh%Mm%Ss")
+      self.data_file_obj = datafile.RecordWriter(
+                        os.path.join(data_dir, "%s_%s" % (roach, timestamp)),
+                        file_attrs=self.register_values(self.file_attr_keys),
+                        max_size=self.max_data_file_size)
+    else:
+      self.data_file_obj = None
     self.RFchannel = {0: SAOfwif.Channel(self, "RF0")}
     # integration (number of accumulations)
     self.spectrum_count = 0
@@ -727,7 +1391,8 @@ class SAOfwif(MC.DeviceReadThread):
     self.daemon = True
     # action will ignore ``scan=0`` until the thread is suspended
     self.scan = 0
-    self.start() # this starts the thread
+    if self.scheduler is None:
+      self.start() # this starts the thread
     #self.suspend_thread()
 
   def initialize_roach(self, RF_gain=0, RFid=0, integr_time=1,
@@ -765,15 +1430,36 @@ class SAOfwif(MC.DeviceReadThread):
     associated header values for each spectrum.  When the number of
     spectra equals the requested number, it stops and reports.
     """
+    msg = self.next_record()
+    if msg is None:
+      return
+    self.parent.combiner.inqueue.put(msg)
+    if msg["type"] == "spectrum":
+      self.parent.timer.mark("queued", self.name, msg["scan"], msg["record"])
+      self.hotlog.debug("action: %s %s %s finished %s", self.name, self.scan,
+                        hotlog.LazyTime(), self.spectrum_count)
+
+  def next_record(self):
+    """
+    Wait for the next record and return the message for the combiner
+
+    This is ``action()`` without the delivery, so that the asyncio acquisition
+    can pass the message on itself.  After the last record of a scan, the
+    message announces the new scan.
+
+    @return: dict, or None if acquisition was stopped during the integration
+    """
     # record number, starts with 0 so first one is 1
     self.spectrum_count += 1
     UNIXtime = nowgmt()
-    self.logger.debug(
-               "action: %s %s %s %s entered",
-               self.name, self.scan, logtime(), self.spectrum_count)
+    timer = self.parent.timer
+    self.hotlog.debug("action: %s %s %s %s entered", self.name, self.scan,
+                      hotlog.LazyTime(), self.spectrum_count)
     if self.spectrum_count > self.max_count:
       # got all spectra for this scan
-      self.suspend_thread()
+      self.acquiring = False
+      if self.scheduler is None:
+        self.suspend_thread()
       self.logger.info("action: %s %d %s done", self.name, self.scan, logtime())
       # increment scan
       self.scan += 1
@@ -785,24 +1471,49 @@ class SAOfwif(MC.DeviceReadThread):
              "scan": self.scan,
              "record": 0,
              "data": None}
-      self.logger.debug("action: %s %s %s new scan to combiner", 
-                        self.name, self.scan, logtime())
-      self.parent.combiner.inqueue.put(msg)
+      self.hotlog.debug("action: %s %s %s new scan to combiner",
+                        self.name, self.scan, hotlog.LazyTime())
     else:
       # Get another integration (accumulation)
       #    this blocks until the spectrum is done
       accum = self.get_next_spectrum()
-      self.logger.debug("action: %s %s %s got integration %d", 
-                        self.name, self.scan, logtime(), self.spectrum_count)
+      if not self.acquiring:
+        self.hotlog.debug("action: %s %s %s stopped",
+                          self.name, self.scan, hotlog.LazyTime())
+        return None
+      timer.mark("integrated", self.name, self.scan, self.spectrum_count)
+      if self.spectrum_count < self.max_count:
+        # the next integration has begun
+        timer.mark("entered", self.name, self.scan, self.spectrum_count+1)
+      self.hotlog.debug("action: %s %s %s got integration %d", self.name,
+                        self.scan, hotlog.LazyTime(), self.spectrum_count)
       msg = {"type":"spectrum", 
              "name": self.name, 
              "time": UNIXtime,
              "scan": self.scan, 
              "record": self.spectrum_count, 
-             "data": list(accum)}
-      self.parent.combiner.inqueue.put(msg)
-      self.logger.debug("action: %s %s %s finished %s",
-                        self.name, self.scan, logtime(), self.spectrum_count)
+             "data": accum}
+      if self.data_file_obj:
+        self.data_file_obj.put(msg, self.register_values(self.accum_reg_keys))
+    return msg
+
+  def stop_acquiring(self):
+    """
+    Stop the scan in progress
+
+    A record being integrated is abandoned and the scan number is advanced so
+    that the next ``sync_start()`` begins a new scan.
+    """
+    self.acquiring = False
+    if self.scheduler is None:
+      self.suspend_thread()
+    else:
+      self.scheduler.cancel(self)
+    self.wakeup.set()
+    self.scan += 1
+    self.spectrum_count = 0
+    self.logger.info("stop_acquiring: %s stopped; next scan is %d",
+                     self.name, self.scan)
         
   def calibrate(self):
     """
@@ -822,14 +1533,45 @@ class SAOfwif(MC.DeviceReadThread):
     """Get an estimate of the FPGA clock speed."""
     return 640.
   
-  def sync_start(self):
+  def sync_start(self, start_time=None):
     """
     Initiate the sync pulses
+
+    @param start_time : when the first integration starts; default: now
+    @type  start_time : float
     """
-    self.end_integr = nowgmt() + self.integr_time
+    if start_time is None:
+      start_time = nowgmt()
+    self.end_integr = start_time + self.integr_time
+    self.wakeup.clear()
     self.logger.debug("sync_start: %s will stop at %s", 
                       self.name, self.end_integr)
-    self.resume_thread()
+    self.acquiring = True
+    # the first integration starts now, whichever way the ROACH is driven
+    self.parent.timer.mark("entered", self.name, self.scan,
+                           self.spectrum_count+1)
+    if self.data_file_obj:
+      self.data_file_obj.begin_scan(self.scan,
+                                    self.register_values(self.scan_attr_keys))
+    if self.scheduler is None:
+      self.resume_thread()
+    else:
+      self.scheduler.schedule(self, self.end_integr)
+
+  def deadline(self):
+    """
+    When ``action()`` is next due, for an AcquisitionScheduler
+
+    After the last record of a scan it is due at once, to finish the scan.
+
+    @return: time in seconds or None if the scan is finished
+    """
+    if not self.acquiring:
+      return None
+    elif self.spectrum_count >= self.max_count:
+      return nowgmt()
+    else:
+      return self.end_integr
     
   def fft_shift_set(self, fft_shift_schedule=int(0b0000000000000000)):
     """
@@ -872,7 +1614,11 @@ class SAOfwif(MC.DeviceReadThread):
     """
     self.integr_time = integr_time
     self.raw_per_sec = int(round(float(self.bandwidth * 1e6) / self.num_chan))
-    self.n_raw = int(round(integr_time * self.raw_per_sec))
+    n_raw = int(round(integr_time * self.raw_per_sec))
+    if n_raw != self.n_raw:
+      # spectra made for the old integration time are no longer valid
+      self._spectra = None
+    self.n_raw = n_raw
     self.logger.info(
       "integr_time_set: %s accum. time set to %2.2f sec (%i raw spectra).",
       self.name, integr_time, self.n_raw)
@@ -896,6 +1642,17 @@ class SAOfwif(MC.DeviceReadThread):
     """
     pass
 
+  def register_values(self, keys):
+    """
+    Read registers for the data file; those with no value are left out
+    """
+    values = {}
+    for key in keys:
+      value = self.read_register(key)
+      if value is not None:
+        values[key] = value
+    return values
+
   def ADC_samples(self, trig_level=-1, timeout=1):
     """
     Returns ADC samples.
@@ -977,13 +1734,36 @@ class SAOfwif(MC.DeviceReadThread):
       spectrum.mean = std *      max_count  * 2**24 / fft_shift
       spectrum.std  = std * sqrt(max_count) * 2**24 / fft_shift
     
-    """
-    rms_radio = RA.rms_noise(T_sys, self.bandwidth*1e6, self.integr_time)/T_sys
-    sampleRMS = self.ADC_samples().std()
-    specmean = sampleRMS * self.n_raw
-    spec = specmean + stats.norm.rvs(sampleRMS, size=self.num_chan)
+    The spectra are simulated ``spectrum_batch_size`` records at a time (see
+    ``get_spectra()``) and this returns a view of the next record in the block.
+    A new block is made when the old one is used up; the old one is not
+    overwritten, so views handed out earlier stay valid.
+    """
+    if self._spectra is None or self._next_spectrum >= len(self._spectra):
+      self.load_spectra(self.get_spectra(self.spectrum_batch_size))
+    spec = self._spectra[self._next_spectrum]
+    self._next_spectrum += 1
     return spec
 
+  def get_spectra(self, n_records):
+    """
+    Simulate a (records x channels) block of spectra in one call
+
+    Each record has its own ADC snap to set its level, as a fresh
+    ``ADC_samples()`` did for each record, so the level follows the RF gain.
+    """
+    scale = ADC_sample_scale(self.RFchannel[0].rf_gain)
+    sample_rms = simulate_ADC_snaps(self.rng, (n_records,),
+                                    scale=scale).std(axis=-1)
+    return simulate_spectra(self.rng, sample_rms, self.n_raw, self.num_chan)
+
+  def load_spectra(self, block):
+    """
+    Use a (records x channels) block for the next calls to ``get_spectrum()``
+    """
+    self._spectra = block
+    self._next_spectrum = 0
+
   def get_next_spectrum(self):
     """
     Suggested by Jonathan::
@@ -1001,12 +1781,32 @@ class SAOfwif(MC.DeviceReadThread):
     """
     # get the current value
     #accum_cnt = self.get_accum_count()
-    done = False
-    while nowgmt() < self.end_integr:  # test at the usec level
-      time.sleep(0.001)
-    self.end_integr = nowgmt() + self.integr_time
+    self.wait_for_integration()
     return self.get_spectrum()
 
+  def wait_for_integration(self):
+    """
+    Sleep until the current integration ends and schedule the next one
+
+    This is one timed wait, not a poll.  The next integration ends one
+    integration time after this one did, not after this method returns, so the
+    records do not drift and all the ROACHs started together stay together.
+    If integrations were missed, the schedule skips to the next boundary.
+    """
+    delay = self.end_integr - nowgmt()
+    while delay > 0:
+      if self.wakeup.wait(delay):
+        # woken up early to stop
+        break
+      delay = self.end_integr - nowgmt()
+    self.end_integr += self.integr_time
+    late = nowgmt() - self.end_integr
+    if late > 0:
+      missed = int(late//self.integr_time) + 1
+      self.logger.warning("wait_for_integration: %s missed %d integrations",
+                          self.name, missed)
+      self.end_integr += missed*self.integr_time
+
   def quit(self):
     """
     """
@@ -1014,8 +1814,9 @@ class SAOfwif(MC.DeviceReadThread):
     #  if hasattr(self.parent, "quit"):
     #    self.parent.callback.finished(("file", self.data_file_obj.file.filename,
     #                                  calendar.timegm(time.gmtime())))
-    self.logger.info("quit: %s closed.", self.data_file_obj.file.filename)
-    #self.data_file_obj.close()
+    if self.data_file_obj:
+      self.data_file_obj.close()
+      self.logger.info("quit: %s closed.", self.data_file_obj.filename)
 
   def help(self):
     return SAOfwif.command_help
@@ -1103,6 +1904,7 @@ class SAOfwif(MC.DeviceReadThread):
       self.RFnum = int(name[-1])
       self.parent = parent
       self.logger = logging.getLogger(parent.logger.name+".Channel")
+      self.hotlog = hotlog.HotLogger(self.logger, "ADC")
       self.logger.debug(" __init__: for %s", self)
       self.freqs = self.parent.freqs
       self.rf = {}
@@ -1126,6 +1928,9 @@ class SAOfwif(MC.DeviceReadThread):
       """
       self.logger.debug("rf_gain_set: setting %s RF%d gain to %5.1f",
                         self.name, self.RFnum, gain)
+      if gain != self.rf_gain:
+        # spectra already simulated were made for the old gain
+        self.parent._spectra = None
       self.rf_gain = gain
       self.rf['gain'] = gain
       self.rf_gain_get()
@@ -1141,15 +1946,17 @@ class SAOfwif(MC.DeviceReadThread):
       Get the contents of the specified ADC snap block. 
       
       This returns a normal distribution of integers with a standard deviation
-      of 57, which corresponds to 0 dBm into the ADC chip.
+      of 60, which corresponds to 0 dBm into the ADC chip, scaled by the RF
+      gain.
 
       @param now : True: a snap is triggered.  False: the last data are read.
       """
-      self.logger.debug("get_ADC_snap: called for %s %s",self.parent.name, self)
-      data = stats.norm.rvs(scale=107/math.sqrt(math.pi), 
-                            size=2048)
-      self.logger.debug("get_ADC_input: returning %d samples", len(data))
-      return numpy.array(data, dtype=numpy.int8)
+      self.hotlog.debug("get_ADC_snap: called for %s %s", self.parent.name,
+                        self)
+      data = simulate_ADC_snaps(self.parent.rng,
+                                scale=ADC_sample_scale(self.rf_gain))
+      self.hotlog.debug("get_ADC_snap: returning %d samples", len(data))
+      return data
 
     def get_ADC_input(self):
       """
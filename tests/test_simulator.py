@@ -0,0 +1,46 @@
+"""
+Tests of the simulated spectra
+"""
+import numpy
+import types
+
+import MonitorControl.BackEnds.ROACH1.simulator as simulator
+
+num_chan = 64
+n_raw = 100
+
+def make_roach(rf_gain):
+  """
+  an SAOfwif with just what ``get_spectra()`` uses
+  """
+  roach = simulator.SAOfwif.__new__(simulator.SAOfwif)
+  roach.rng = numpy.random.default_rng(1)
+  roach.n_raw = n_raw
+  roach.num_chan = num_chan
+  roach.RFchannel = {0: types.SimpleNamespace(rf_gain=rf_gain)}
+  return roach
+
+def test_roach_spectra_follow_rf_gain():
+  low = make_roach(-20.).get_spectra(32).mean()
+  high = make_roach(-10.).get_spectra(32).mean()
+  # 10 dB more gain; int8 samples make the low level a little uncertain
+  assert abs(high/low/10**0.5 - 1) < 0.1
+
+def test_backend_spectra_follow_rf_gain():
+  backend = simulator.SAObackend.__new__(simulator.SAObackend)
+  backend.rng = numpy.random.default_rng(1)
+  backend.roach = {"roach1": make_roach(-20.), "roach2": make_roach(-10.)}
+  backend._roachkeys = ["roach1", "roach2"]
+  spectra = backend.get_spectra(32)
+  low, high = spectra.mean(axis=(1, 2))
+  # 10 dB more gain; int8 samples make the low level a little uncertain
+  assert abs(high/low/10**0.5 - 1) < 0.1
+
+def test_spectra_agree_with_ADC_levels():
+  rf_gain = -10.
+  rng = numpy.random.default_rng(1)
+  snaps = simulator.simulate_ADC_snaps(rng, (32,),
+                                       scale=simulator.ADC_sample_scale(rf_gain))
+  sample_std = simulator.ADC_levels(snaps)["sample std"].mean()
+  spectra = make_roach(rf_gain).get_spectra(32)
+  assert abs(spectra.mean()/(n_raw + 1)/sample_std - 1) < 0.02
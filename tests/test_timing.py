@@ -0,0 +1,39 @@
+"""
+Tests of the pipeline stage timer
+"""
+import serpent
+
+import MonitorControl.BackEnds.ROACH1.timing as timing
+
+def make_timer():
+  """
+  a timer with two records from two ROACHs through every stage
+  """
+  timer = timing.StageTimer()
+  for record in (1, 2):
+    for stage in timing.stages:
+      if stage in timing.combined_stages:
+        timer.mark(stage, None, 1, record)
+      else:
+        for roach in ("roach1", "roach2"):
+          timer.mark(stage, roach, 1, record)
+  return timer
+
+def roundtrip(value):
+  return serpent.loads(serpent.dumps(value))
+
+def test_combined_interval_key():
+  stats = make_timer().stats("delivery")
+  assert list(stats) == [timing.combined]
+  assert stats[timing.combined]["count"] == 2
+
+def test_stats_survive_serpent():
+  timer = make_timer()
+  for interval in timing.intervals:
+    stats = timer.stats(interval)
+    assert roundtrip(stats) == stats
+
+def test_histogram_survives_serpent():
+  histogram = make_timer().histogram("delivery", bins=4)
+  assert roundtrip(histogram) == histogram
+  assert sum(histogram["counts"][timing.combined]) == 2
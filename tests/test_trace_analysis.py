@@ -0,0 +1,32 @@
+"""
+Tests of apps/trace_analysis.py
+"""
+import importlib.util
+import os
+
+import MonitorControl.BackEnds.ROACH1.timing as timing
+
+def load_app():
+  path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "apps",
+                      "trace_analysis.py")
+  spec = importlib.util.spec_from_file_location("trace_analysis", path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+def test_delivery_is_reported(tmp_path):
+  filename = str(tmp_path/"trace.bin")
+  timer = timing.StageTimer()
+  timer.start_trace(filename, ["roach1", "roach2"])
+  for stage in timing.stages:
+    if stage in timing.combined_stages:
+      timer.mark(stage, None, 1, 1)
+    else:
+      for roach in ("roach1", "roach2"):
+        timer.mark(stage, roach, 1, 1)
+  timer.stop_trace()
+  header, events = timing.read_trace(filename)
+  summary = load_app().summarize(header, events)
+  assert list(summary["delivery"]) == [timing.combined]
+  assert len(summary["delivery"][timing.combined]) == 1
+  assert sorted(summary["total"]) == ["roach1", "roach2"]
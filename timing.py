@@ -0,0 +1,280 @@
+"""
+Per-stage timing of the acquisition pipeline
+
+Each record passes through these stages::
+
+  entered     - the integration begins: at ``sync_start()`` for the first
+                record and when the previous record is read for the others,
+                so it means the same with every acquisition mode
+  integrated  - the accumulated spectrum has been read
+  queued      - the record has been put on the combiner's input queue
+  received    - the combiner has taken it off the queue
+  stored      - it is in the combiner's scan buffer
+  emitted     - all the ROACHs' records are in and the combined record is
+                being processed
+  delivered   - the client callback has returned
+
+A ``StageTimer`` records (stage, roach, scan, record, time) for each of these
+in a bounded ``collections.deque``.  Appending to a deque is atomic, so the
+threads marking stages never wait for a lock.  The time is
+``time.monotonic()``.  The combined stages have no ROACH; their latencies are
+reckoned from each ROACH's earlier stage, and those from one combined stage
+to another are reported under ``combined``, since Pyro's serializer cannot
+take None as a key.  This replaces scraping DEBUG log
+lines as ``apps/anal_servertest.py`` does.
+
+The events can also be appended to a binary trace file of fixed-size
+``trace_dtype`` records::
+
+  stage   - index in ``stages``
+  roach   - index in the header's ROACH names; -1 for combined stages
+  scan
+  record
+  time    - time.monotonic()
+
+with a JSON header in a file of the same name plus ".json" which lists the
+stages and ROACH names and the offset from monotonic to UNIX time.  Trace
+writes go through a lock and a buffered file, so they cost a little more than
+the deque.
+``read_trace()`` maps such a file and ``trace_latencies()`` computes the
+latencies of every record for an interval in a few array operations; see
+``apps/trace_analysis.py``.
+"""
+import collections
+import json
+import logging
+import numpy
+import os
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+stages = ("entered", "integrated", "queued", "received", "stored", "emitted",
+          "delivered")
+intervals = {"integration": ("entered",    "integrated"),
+             "reading":     ("integrated", "queued"),
+             "queue":       ("queued",     "received"),
+             "combining":   ("received",   "stored"),
+             "waiting":     ("stored",     "emitted"),
+             "delivery":    ("emitted",    "delivered"),
+             "total":       ("entered",    "delivered")}
+combined_stages = ("emitted", "delivered")
+combined = "combined"
+trace_dtype = numpy.dtype([("stage", "<u2"), ("roach", "<i2"), ("scan", "<i4"),
+                           ("record", "<i4"), ("time", "<f8")])
+trace_struct = struct.Struct("<Hhiid")
+
+def trace_header_name(filename):
+  return filename + ".json"
+
+def read_trace(filename):
+  """
+  map a trace file
+
+  @return: (header dict, structured array of trace_dtype)
+  """
+  with open(trace_header_name(filename)) as headerfile:
+    header = json.load(headerfile)
+  nbytes = os.path.getsize(filename)
+  count = nbytes//trace_dtype.itemsize
+  if count:
+    events = numpy.memmap(filename, dtype=trace_dtype, mode="r",
+                          shape=(count,))
+  else:
+    events = numpy.zeros(0, dtype=trace_dtype)
+  return header, events
+
+def _record_keys(roach, scan, record):
+  """
+  one int64 per (roach, scan, record) for matching events
+  """
+  return ((roach.astype(numpy.int64) + 1) << 48) | \
+         (scan.astype(numpy.int64) << 24) | record.astype(numpy.int64)
+
+def trace_latencies(header, events, start, end):
+  """
+  times from one stage to another for every record in a trace
+
+  @param header : trace header from ``read_trace()``
+  @param events : trace records from ``read_trace()``
+
+  @param start : earlier stage
+  @type  start : str
+
+  @param end : later stage
+  @type  end : str
+
+  @return: (roach index array, latency array in seconds)
+  """
+  names = header["stages"]
+  begun = events[events["stage"] == names.index(start)]
+  ended = events[events["stage"] == names.index(end)]
+  if end in combined_stages:
+    # match on scan and record only
+    roach = numpy.full(len(begun), -1, dtype=numpy.int16)
+  else:
+    roach = begun["roach"]
+  wanted = _record_keys(roach, begun["scan"], begun["record"])
+  keys = _record_keys(ended["roach"], ended["scan"], ended["record"])
+  order = numpy.argsort(keys, kind="stable")
+  keys = keys[order]
+  where = numpy.searchsorted(keys, wanted)
+  where[where == len(keys)] = 0
+  found = (keys[where] == wanted) if len(keys) else \
+                                          numpy.zeros(len(wanted), dtype=bool)
+  latency = ended["time"][order][where[found]] - begun["time"][found]
+  return begun["roach"][found], latency
+
+class StageTimer(object):
+  """
+  Timestamps of records passing through the pipeline stages
+
+  Attributes::
+    enabled - stages are recorded only when True
+    events  - deque of (stage, roach, scan, record, time)
+    logger  - logging.Logger instance
+    trace   - binary trace file being written, if any
+  """
+  def __init__(self, size=100000, enabled=True):
+    """
+    @param size : most events to keep; the oldest are dropped
+    @type  size : int
+    """
+    self.logger = logging.getLogger(logger.name+".StageTimer")
+    self.enabled = enabled
+    self.events = collections.deque(maxlen=size)
+    self.trace = None
+    self.stage_ids = {stage: num for num, stage in enumerate(stages)}
+    self._trace_lock = threading.Lock()
+
+  def mark(self, stage, roach, scan, record):
+    """
+    record that a record reached a stage; ``roach`` is None for combined
+    records
+    """
+    if self.enabled:
+      now = time.monotonic()
+      self.events.append((stage, roach, scan, record, now))
+      if self.trace:
+        self._trace_event(stage, roach, scan, record, now)
+
+  def start_trace(self, filename, roaches):
+    """
+    append events to a binary trace file as well
+
+    @param filename : trace file; the header goes in filename + ".json"
+    @type  filename : str
+
+    @param roaches : ROACH names, which are numbered in this order
+    @type  roaches : list of str
+    """
+    self.stop_trace()
+    self.trace_filename = filename
+    self.roach_ids = {name: num for num, name in enumerate(roaches)}
+    self._write_trace_header()
+    self.trace = open(filename, "ab")
+    self.logger.info("start_trace: writing %s", filename)
+
+  def stop_trace(self):
+    """
+    close the trace file
+    """
+    with self._trace_lock:
+      if self.trace:
+        self.trace.close()
+        self.logger.info("stop_trace: %s closed", self.trace_filename)
+      self.trace = None
+
+  def _write_trace_header(self):
+    names = sorted(self.roach_ids, key=self.roach_ids.get)
+    header = {"stages": list(stages), "roaches": names,
+              "time_offset": time.time() - time.monotonic()}
+    with open(trace_header_name(self.trace_filename), "w") as headerfile:
+      json.dump(header, headerfile)
+
+  def _trace_event(self, stage, roach, scan, record, now):
+    """
+    append one event to the trace file
+    """
+    with self._trace_lock:
+      if not self.trace:
+        return
+      if roach is None:
+        roach_id = -1
+      else:
+        if roach not in self.roach_ids:
+          self.roach_ids[roach] = len(self.roach_ids)
+          self._write_trace_header()
+        roach_id = self.roach_ids[roach]
+      self.trace.write(trace_struct.pack(self.stage_ids[stage], roach_id, scan,
+                                         record, now))
+
+  def clear(self):
+    self.events.clear()
+
+  def latencies(self, start, end):
+    """
+    times from one stage to another, by ROACH
+
+    @param start : earlier stage
+    @type  start : str
+
+    @param end : later stage
+    @type  end : str
+
+    @return: dict of arrays of seconds keyed by ROACH name, or ``combined``
+    """
+    if start not in stages or end not in stages:
+      raise ValueError("unknown stage in %s, %s" % (start, end))
+    begun = {}
+    ended = {}
+    for stage, roach, scan, record, when in list(self.events):
+      if stage == start:
+        begun[(roach, scan, record)] = when
+      elif stage == end:
+        ended[(roach, scan, record)] = when
+    result = collections.defaultdict(list)
+    for (roach, scan, record), when in begun.items():
+      # a combined stage has no ROACH
+      finish = ended.get((roach, scan, record),
+                         ended.get((None, scan, record)))
+      if finish is not None:
+        result[combined if roach is None else roach].append(finish - when)
+    return {roach: numpy.array(values) for roach, values in result.items()}
+
+  def stats(self, interval="total"):
+    """
+    latency statistics for an interval, by ROACH
+
+    @param interval : a key of ``intervals``
+    @type  interval : str
+
+    @return: dict keyed by ROACH name of dicts with count, mean, min, max and
+             50, 90 and 99 percentiles in seconds
+    """
+    result = {}
+    for roach, values in self.latencies(*intervals[interval]).items():
+      if not len(values):
+        continue
+      p50, p90, p99 = numpy.percentile(values, [50, 90, 99])
+      result[roach] = {"count": len(values), "mean": float(values.mean()),
+                       "min": float(values.min()), "max": float(values.max()),
+                       "p50": float(p50), "p90": float(p90), "p99": float(p99)}
+    return result
+
+  def histogram(self, interval="total", bins=20):
+    """
+    latency histograms for an interval, by ROACH, with common bins
+
+    @return: dict with 'edges' (seconds) and 'counts' keyed by ROACH name
+    """
+    latencies = self.latencies(*intervals[interval])
+    if not latencies:
+      return {"edges": [], "counts": {}}
+    edges = numpy.histogram_bin_edges(numpy.concatenate(
+                                         list(latencies.values())), bins=bins)
+    return {"edges": edges.tolist(),
+            "counts": {roach: numpy.histogram(values, bins=edges)[0].tolist()
+                       for roach, values in latencies.items()}}
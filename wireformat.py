@@ -0,0 +1,104 @@
+"""
+Binary wire format for combined spectrometer records
+
+A combined record (see ``combiner``) is a dict with keys 'scan', 'record',
+'time', 'data' and 'missing', where 'time' and 'data' are dicts keyed by ROACH name.
+Sent through Pyro as lists, the spectra make several MB per record.  This
+packs a record into one ``bytes`` object::
+
+  header  - struct HEADER: magic, version, dtype code, number of ROACHs,
+            number of channels, scan, record, length of the names block
+  names   - ROACH names in order, UTF-8, separated by newlines
+  times   - little-endian float64, one per ROACH
+  data    - little-endian float32 or float64, (ROACHs x channels), row major
+  missing - one byte per ROACH, 1 if it had not reported and its spectrum is
+            NaN (see ``combiner``)
+
+The missing flags were added in version 2; ``unpack_record`` also reads
+version 1 records, which have none.
+
+Pyro's serpent serializer sends ``bytes`` as a base64 dict; ``unpack_record``
+accepts that as well as raw bytes.
+"""
+import logging
+import numpy
+import serpent
+import struct
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"SAOR"
+VERSION = 2
+versions = (1, 2)
+HEADER = struct.Struct("<4sBcHIIII")
+dtypes = {b"f": numpy.dtype("<f4"), b"d": numpy.dtype("<f8")}
+codes = {dtype: code for code, dtype in dtypes.items()}
+wire_formats = {"lists": None, "float32": "<f4", "float64": "<f8"}
+
+def pack_record(msg, dtype="<f4"):
+  """
+  Pack a combined record into bytes
+
+  @param msg : combined record with spectra as arrays (or lists)
+  @type  msg : dict
+
+  @param dtype : little-endian float32 ("<f4") or float64 ("<f8")
+  @type  dtype : str
+
+  @return: bytes
+  """
+  dtype = numpy.dtype(dtype)
+  names = list(msg["data"].keys())
+  num_chan = len(msg["data"][names[0]])
+  data = numpy.empty((len(names), num_chan), dtype=dtype)
+  for index, name in enumerate(names):
+    data[index] = msg["data"][name]
+  times = numpy.array([msg["time"][name] for name in names], dtype="<f8")
+  missing = msg.get("missing", [])
+  flags = numpy.array([name in missing for name in names], dtype="u1")
+  name_block = "\n".join(names).encode("utf-8")
+  header = HEADER.pack(MAGIC, VERSION, codes[dtype], len(names), num_chan,
+                       msg["scan"], msg["record"], len(name_block))
+  return b"".join([header, name_block, times.tobytes(), data.tobytes(),
+                   flags.tobytes()])
+
+def is_packed(msg):
+  """
+  True if ``msg`` is a packed record, either raw or as sent by serpent
+  """
+  if isinstance(msg, dict):
+    return msg.get("encoding") == "base64" and "data" in msg
+  return isinstance(msg, (bytes, bytearray, memoryview))
+
+def unpack_record(buf):
+  """
+  Unpack a record made by ``pack_record``
+
+  The spectra are read-only numpy arrays sharing memory with ``buf``.
+
+  @return: dict like the combined record that was packed
+  """
+  if isinstance(buf, dict):
+    buf = serpent.tobytes(buf)
+  magic, version, code, n_roach, num_chan, scan, record, name_len = \
+                                                       HEADER.unpack_from(buf)
+  if magic != MAGIC or version not in versions:
+    raise ValueError("not a version %s packed record" % (versions,))
+  offset = HEADER.size
+  names = bytes(buf[offset:offset+name_len]).decode("utf-8").split("\n")
+  offset += name_len
+  times = numpy.frombuffer(buf, dtype="<f8", count=n_roach, offset=offset)
+  offset += times.nbytes
+  data = numpy.frombuffer(buf, dtype=dtypes[code], count=n_roach*num_chan,
+                          offset=offset).reshape(n_roach, num_chan)
+  offset += data.nbytes
+  if version >= 2:
+    flags = numpy.frombuffer(buf, dtype="u1", count=n_roach, offset=offset)
+    missing = [name for index, name in enumerate(names) if flags[index]]
+  else:
+    missing = []
+  return {"scan": scan, "record": record, "type": "data",
+          "time": {name: float(times[index])
+                   for index, name in enumerate(names)},
+          "data": {name: data[index] for index, name in enumerate(names)},
+          "missing": missing}